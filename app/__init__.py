@@ -16,6 +16,7 @@ from sqlalchemy import MetaData
 from flask_migrate import Migrate
 from flask_wtf.csrf import CSRFProtect
 from flask_bootstrap import Bootstrap
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
@@ -23,6 +24,12 @@ if os.path.exists(dotenv_path):
 
 app = Flask(__name__, static_folder='static', static_url_path='')
 app.config.from_object(Config)
+if app.config.get('PROXY_COUNT'):
+    # behind reverse proxies remote_addr is the proxy, the client address
+    # (used by the API rate limits and the country lookup) comes from the
+    # X-Forwarded-For entries the PROXY_COUNT trusted proxies have added
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'],
+                            x_proto=app.config['PROXY_COUNT'])
 naming_convention = {
     "ix": 'ix_%(column_0_label)s',
     "uq": "uq_%(table_name)s_%(column_0_name)s",
@@ -42,7 +49,7 @@ babel = Babel(app)
 moment = Moment(app)
 cache = Cache(app)
 
-from app import views, models, errors, api
+from app import views, models, errors, api, cli, limiter
 from app.models import *
 from app.admin import *
 from .bot import send_bot_message
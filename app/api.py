@@ -1,14 +1,23 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 from flask import g, jsonify, request, url_for
 from flask_login import current_user
 
 from app import app, db, csrf
 from app.errors import error_response
-from app.functions import get_free_time_intervals, time_in_intervals, get_duration
-from app.models import Location, Staff, Service, Appointment, Client
+from app.functions import (get_free_time_intervals, time_in_intervals,
+                           get_duration, get_next_free_slots, get_date_list,
+                           get_free_time_intervals_bulk, create_appointments)
+from app.models import (Location, Staff, Service, Appointment, Client,
+                        SYNC_MODELS)
+from app.sync import get_changes, encode_cursor, decode_cursor
 from app.auth import basic_auth, token_auth
 
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+API_MAX_DAYS = 92
+API_MAX_BULK = 1000
+
 
 @app.route('/api/get_token/')
 @basic_auth.login_required
@@ -17,44 +26,76 @@ def api_get_token():
     return jsonify({'token': token})
 
 
+def get_list_response(class_object):
+    # ?cursor=<id>&limit=<rows>&fields=<a,b>&updated_since=<ISO datetime>
+    args = request.args
+    fields = [f.strip() for f in args.get('fields', '').split(',') if f.strip()]
+    columns = class_object.get_columns(fields)
+    if columns is None:
+        return error_response(400, message='Unknown field')
+    try:
+        after_id = int(args.get('cursor') or 0)
+        limit = min(max(int(args.get('limit', API_PAGE_SIZE)), 1),
+                    API_MAX_PAGE_SIZE)
+        data_search = []
+        if args.get('updated_since'):
+            since = datetime.fromisoformat(args['updated_since'])
+            if since.tzinfo:
+                since = since.astimezone(timezone.utc).replace(tzinfo=None)
+            data_search.append(class_object.timestamp_update >= since)
+    except ValueError:
+        return error_response(400, message='Incorrect value')
+    rows, more = class_object.get_rows(after_id, limit, columns, data_search)
+    return jsonify({'items': {row['id']: row for row in rows},
+                    'next_cursor': str(rows[-1]['id']) if more else None})
+
+
 @app.route('/api/get_locations/')
 @token_auth.login_required
 def api_get_locations():
-    locations = {}
-    for location in Location.get_items():
-        data = location.get_dict()
-        locations[location.name] = data
-    return jsonify(locations)
+    return get_list_response(Location)
 
 
 @app.route('/api/get_staff/')
 @token_auth.login_required
 def api_get_staff():
-    staff = {}
-    for worker in Staff.get_items():
-        data = worker.get_dict()
-        staff[worker.name] = data
-    return jsonify(staff)
+    return get_list_response(Staff)
 
 
 @app.route('/api/get_clients/')
 @token_auth.login_required
 def api_get_clients():
-    clients = {}
-    for client in Client.get_items():
-        data = client.get_dict()
-        clients[client.name] = data
-    return jsonify(clients)
+    return get_list_response(Client)
 
 
 @app.route('/api/get_services/')
 @token_auth.login_required
 def api_get_services():
-    services = {}
-    for service in Service.get_items():
-        data = service.get_dict()
-        services[service.name] = data
-    return jsonify(services)
+    return get_list_response(Service)
+
+
+@app.route('/api/changes/')
+@token_auth.login_required
+def api_get_changes():
+    # ?cursor=<cursor of the previous response>&limit=<rows>&tables=<a,b>
+    args = request.args
+    key = None
+    if args.get('cursor'):
+        key = decode_cursor(args['cursor'])
+        if key is None:
+            return error_response(400, message='Incorrect cursor')
+    tables = [t.strip() for t in args.get('tables', '').split(',') if t.strip()]
+    if any(table not in SYNC_MODELS for table in tables):
+        return error_response(400, message='Unknown table')
+    try:
+        limit = min(max(int(args.get('limit', API_PAGE_SIZE)), 1),
+                    API_MAX_PAGE_SIZE)
+    except ValueError:
+        return error_response(400, message='Incorrect value')
+    changes, key, more = get_changes(key, limit, tables)
+    return jsonify({'changes': changes,
+                    'cursor': encode_cursor(key) if key else None,
+                    'more': more})
 
 
 @csrf.exempt
@@ -77,6 +118,87 @@ def api_get_free_time_intervals():
     return jsonify(intervals)
 
 
+@csrf.exempt
+@app.route('/api/get_free_time_intervals_bulk/', methods=['POST'])
+@token_auth.login_required
+def api_get_free_time_intervals_bulk():
+    # intervals[i][j] are the free intervals of staff[i] on dates[j]
+    data = request.get_json() or {}
+    if 'location_id' not in data:
+        return error_response(400, message='Data must include location_id')
+    if 'dates' not in data and 'date_from' not in data:
+        return error_response(400, message='Data must include dates or date_from')
+    if 'duration' not in data and 'services_id' not in data:
+        return error_response(400, message='Data must include duration or services')
+    try:
+        location_id = int(data['location_id'])
+        if 'dates' in data:
+            dates = sorted(set(datetime.strptime(d, '%Y-%m-%d').date()
+                               for d in data['dates']))
+        else:
+            date_from = datetime.strptime(data['date_from'], '%Y-%m-%d').date()
+            date_to = date_from
+            if 'date_to' in data:
+                date_to = datetime.strptime(data['date_to'], '%Y-%m-%d').date()
+            dates = get_date_list(date_from, date_to)
+        if 'services_id' in data:
+            duration = get_duration(str(data['services_id']).split(';'))
+        else:
+            duration = timedelta(minutes=int(data['duration']))
+        if 'staff_ids' in data:
+            staff_ids = sorted(set(map(int, data['staff_ids'])))
+        else:
+            staff_ids = [s.id for s in Staff.get_items()]
+    except (ValueError, TypeError):
+        return error_response(400, message='Incorrect value')
+    if not dates or len(dates) > API_MAX_DAYS:
+        return error_response(400, message='Incorrect number of dates')
+    if duration <= timedelta():
+        return error_response(400, message='Duration must be positive')
+    found = set(s.id for s in Staff.get_objects(staff_ids, mode_404=False))
+    if any(staff_id not in found for staff_id in staff_ids):
+        return error_response(404, message='Staff not found')
+    result = get_free_time_intervals_bulk(location_id, dates, staff_ids,
+                                          duration)
+    return jsonify({'staff': staff_ids,
+                    'dates': [d.strftime('%Y-%m-%d') for d in dates],
+                    'intervals': [[[[start.strftime('%H:%M'),
+                                     end.strftime('%H:%M')]
+                                    for start, end in result[staff_id][d]]
+                                   for d in dates]
+                                  for staff_id in staff_ids]})
+
+
+@csrf.exempt
+@app.route('/api/get_next_free_slots/', methods=['POST'])
+@token_auth.login_required
+def api_get_next_free_slots():
+    data = request.get_json() or {}
+    if 'services_id' not in data:
+        return error_response(400, message='Data must include services')
+    try:
+        services = list(map(int, str(data['services_id']).split(';')))
+        count = min(max(int(data.get('count', 10)), 1), 100)
+        days = min(int(data.get('days', 14)), 92)
+        date_from = None
+        if 'date' in data:
+            date_from = datetime.strptime(data['date'], '%Y-%m-%d').date()
+        location_id = data.get('location_id')
+        if location_id is not None:
+            location_id = int(location_id)
+        staff_id = data.get('staff_id')
+        if staff_id is not None:
+            staff_id = int(staff_id)
+        slots = get_next_free_slots(services, count, days, location_id,
+                                    staff_id, date_from)
+    except (ValueError, TypeError):
+        return error_response(400, message='Incorrect value')
+    return jsonify([{'date_time': dt.strftime('%Y-%m-%d %H:%M'),
+                     'location_id': location_id,
+                     'staff_id': staff_id}
+                    for dt, location_id, staff_id in slots])
+
+
 @csrf.exempt
 @app.route('/api/create_client/', methods=['POST'])
 @token_auth.login_required
@@ -91,7 +213,7 @@ def api_create_client():
         phone = data['phone'].strip()
         if Client.find_object(data_filter={'name': name}):
             return error_response(400, message='Name is already in use')
-        if Client.find_object(data_filter={'phone': phone}):
+        if Client.find_by_phone(phone):
             return error_response(400, message='Phone number is already in use')
         client = Client(cid=current_user.cid,
                         name=name,
@@ -148,7 +270,8 @@ def api_create_appointment():
         intervals = get_free_time_intervals(data['location_id'],
                                             dt.date(),
                                             data['staff_id'],
-                                            get_duration(services))
+                                            get_duration(services),
+                                            cached=False)
         if not intervals or not time_in_intervals(dt, intervals):
             return error_response(400, message='No free time')
         appointment = Appointment(cid=current_user.cid,
@@ -158,8 +281,7 @@ def api_create_appointment():
                                   staff_id=int(data['staff_id']))
         db.session.add(appointment)
         db.session.flush()
-        for service_id in services:
-            service = Service.get_object(service_id)
+        for service in Service.get_objects(services):
             appointment.add_service(service)
         db.session.commit()
         response = jsonify(appointment.get_dict())
@@ -170,6 +292,50 @@ def api_create_appointment():
         return error_response(400, message='Incorrect value')
 
 
+@csrf.exempt
+@app.route('/api/create_appointments/', methods=['POST'])
+@token_auth.login_required
+def api_create_appointments():
+    # {"appointments": [...], "check_free_time": true}, the items take the
+    # fields of create_appointment; results are reported per item
+    data = request.get_json() or {}
+    if not isinstance(data.get('appointments'), list):
+        return error_response(400, message='Data must include appointments')
+    if len(data['appointments']) > API_MAX_BULK:
+        return error_response(400, message='Too many appointments')
+    items = []
+    results = []
+    for index, item in enumerate(data['appointments']):
+        try:
+            items.append({'location_id': int(item['location_id']),
+                          'staff_id': int(item['staff_id']),
+                          'client_id': int(item['client_id']),
+                          'date_time': datetime.strptime(item['date_time'],
+                                                         '%Y-%m-%d %H:%M'),
+                          'services': list(map(int, str(
+                              item['services_id']).split(';'))),
+                          'info': item.get('info')})
+            results.append(None)
+        except KeyError as e:
+            results.append({'index': index,
+                            'error': 'Data must include {}'.format(e.args[0])})
+        except (ValueError, TypeError, AttributeError):
+            results.append({'index': index, 'error': 'Incorrect value'})
+    created = iter(create_appointments(items,
+                                       data.get('check_free_time', True)))
+    for index, result in enumerate(results):
+        if result is not None:
+            continue
+        appointment = next(created)
+        if isinstance(appointment, str):
+            results[index] = {'index': index, 'error': appointment}
+        else:
+            results[index] = {'index': index, 'id': appointment.id}
+    db.session.commit()
+    return jsonify({'created': sum('id' in r for r in results),
+                    'results': results})
+
+
 @app.route('/api/get_appointment/<id>')
 @token_auth.login_required
 def api_get_appointment(id):
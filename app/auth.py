@@ -1,13 +1,94 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+
 from flask import g
+from flask.sessions import SecureCookieSessionInterface
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from flask_login import login_user
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
 
+from app import app, db
 from app.models import User
 from app.errors import error_response
 
 basic_auth = HTTPBasicAuth()
 token_auth = HTTPTokenAuth()
 
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TIMEOUT = 60
+
+
+class TokenCache:
+    # token -> (user columns, valid until) of the last verified tokens, an
+    # entry lives until token_expiration or the timeout, whichever is sooner;
+    # the timeout bounds how long other processes accept a revoked token
+
+    def __init__(self, size=TOKEN_CACHE_SIZE, timeout=TOKEN_CACHE_TIMEOUT):
+        self.size = size
+        self.timeout = timedelta(seconds=timeout)
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, token):
+        with self.lock:
+            item = self.items.get(token)
+            if item is None:
+                return None
+            if item[1] <= datetime.utcnow():
+                del self.items[token]
+                return None
+            self.items.move_to_end(token)
+            return item[0]
+
+    def set(self, token, user):
+        valid_until = min(user.token_expiration,
+                          datetime.utcnow() + self.timeout)
+        with self.lock:
+            self.items[token] = (user.get_dict(), valid_until)
+            self.items.move_to_end(token)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def remove_user(self, user_id):
+        with self.lock:
+            for token in [t for t, (data, _) in self.items.items()
+                          if data['id'] == user_id]:
+                del self.items[token]
+
+
+token_cache = TokenCache()
+
+
+class TokenSessionInterface(SecureCookieSessionInterface):
+    # Requests authenticated by a token do not write the session cookie
+    # that login_user fills in
+
+    def save_session(self, *args, **kwargs):
+        if g.get('login_via_token'):
+            return
+        return super(TokenSessionInterface, self).save_session(*args, **kwargs)
+
+
+app.session_interface = TokenSessionInterface()
+
+
+def get_cached_user(data):
+    # Attach the cached state to the session without loading the row
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+@db.event.listens_for(User.token, 'set')
+@db.event.listens_for(User.token_expiration, 'set')
+def invalidate_token(target, value, oldvalue, initiator):
+    # get_token issues a new token, revoke_token moves the expiration;
+    # users built from the cache are not persistent yet and are skipped
+    if inspect(target).persistent:
+        token_cache.remove_user(target.id)
+
 
 @basic_auth.verify_password
 def verify_password(login, password):
@@ -25,9 +106,19 @@ def basic_auth_error():
 
 @token_auth.verify_token
 def verify_token(token):
-    g.current_user = User.check_token(token) if token else None
+    if not token:
+        g.current_user = None
+        return False
+    data = token_cache.get(token)
+    if data is not None:
+        g.current_user = get_cached_user(data)
+    else:
+        g.current_user = User.check_token(token)
+        if g.current_user:
+            token_cache.set(token, g.current_user)
     if g.current_user:
-        login_user(g.current_user)
+        g.login_via_token = True
+        login_user(g.current_user, remember=False)
     return g.current_user is not None
 
 
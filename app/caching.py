@@ -0,0 +1,128 @@
+from datetime import datetime
+
+from flask_login import current_user
+from sqlalchemy import inspect, select
+
+from app import cache, db
+from .versions import make_key, get_versions, bump_versions
+from .models import (Appointment, Holiday, ScheduleDay, Staff, Location,
+                     CompanyConfig, staff_schedules, locations_schedules)
+
+# Free time is invalidated by version bumps written to the cache on commit,
+# so every process must share one cache (CACHE_TYPE redis or memcached); with
+# a per-process SimpleCache other workers keep serving stale free time until
+# AVAILABILITY_TIMEOUT. Checks before saving an appointment bypass the cache.
+AVAILABILITY_TIMEOUT = 3600
+
+
+def get_availability_keys(location_id, dates, staff_ids, duration,
+                          appointment_id=None):
+    cid = current_user.cid
+    today = datetime.now().date()
+    version_keys = [('availability', cid),
+                    ('availability', cid, 'location', location_id)]
+    for staff_id in staff_ids:
+        version_keys.append(('availability', cid, 'staff', staff_id))
+        for date in dates:
+            version_keys.append(('availability', cid, 'day', staff_id, date))
+    versions = get_versions(version_keys)
+    base = [cid, location_id, int(duration.total_seconds() // 60),
+            appointment_id or 0, versions[version_keys[0]],
+            versions[version_keys[1]]]
+    keys = {}
+    for staff_id in staff_ids:
+        staff_version = versions[('availability', cid, 'staff', staff_id)]
+        for date in dates:
+            day_version = versions[('availability', cid, 'day', staff_id,
+                                    date)]
+            now = datetime.now().strftime('%H%M') if date == today else ''
+            keys[(staff_id, date)] = make_key('availability', *base, staff_id,
+                                              date, now, staff_version,
+                                              day_version)
+    return keys
+
+
+def get_cached_availability(keys):
+    items = list(keys.items())
+    values = cache.get_many(*[key for _, key in items]) if items else []
+    return {item: value for (item, _), value in zip(items, values)
+            if value is not None}
+
+
+def set_cached_availability(keys, data):
+    cache.set_many({keys[item]: value for item, value in data.items()
+                    if item in keys}, timeout=AVAILABILITY_TIMEOUT)
+
+
+def get_history_values(obj, attr):
+    # the parts of a history are None for attributes never set
+    values = set(inspect(obj).attrs[attr].history.sum())
+    if not values:
+        values = {getattr(obj, attr)}
+    return values
+
+
+def is_modified(obj, attr):
+    return inspect(obj).attrs[attr].history.has_changes()
+
+
+def get_availability_changes(session):
+    keys = set()
+    schedule_ids = set()
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        cid = getattr(obj, 'cid', None)
+        if isinstance(obj, Appointment):
+            for staff_id in get_history_values(obj, 'staff_id'):
+                for date_time in get_history_values(obj, 'date_time'):
+                    if staff_id and date_time:
+                        keys.add(('availability', cid, 'day', staff_id,
+                                  date_time.date()))
+        elif isinstance(obj, Holiday):
+            for staff_id in get_history_values(obj, 'staff_id'):
+                for date in get_history_values(obj, 'date'):
+                    if staff_id and date:
+                        keys.add(('availability', cid, 'day', staff_id, date))
+        elif isinstance(obj, ScheduleDay):
+            schedule_ids.update(get_history_values(obj, 'schedule_id'))
+        elif isinstance(obj, (Staff, Location)):
+            if (obj in session.dirty and not is_modified(obj, 'schedules')
+                    and not is_modified(obj, 'no_active')):
+                continue
+            scope = 'staff' if isinstance(obj, Staff) else 'location'
+            keys.add(('availability', cid, scope, obj.id))
+        elif isinstance(obj, CompanyConfig):
+            if is_modified(obj, 'simple_mode'):
+                keys.add(('availability', cid))
+    schedule_ids.discard(None)
+    if schedule_ids:
+        staff = session.execute(
+            select(Staff.cid, staff_schedules.c.staff_id).join(
+                staff_schedules, Staff.id == staff_schedules.c.staff_id).where(
+                staff_schedules.c.schedule_id.in_(schedule_ids)))
+        for cid, staff_id in staff:
+            keys.add(('availability', cid, 'staff', staff_id))
+        locations = session.execute(
+            select(Location.cid, locations_schedules.c.location_id).join(
+                locations_schedules,
+                Location.id == locations_schedules.c.location_id).where(
+                locations_schedules.c.schedule_id.in_(schedule_ids)))
+        for cid, location_id in locations:
+            keys.add(('availability', cid, 'location', location_id))
+    return keys
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def collect_availability_changes(session, flush_context):
+    keys = get_availability_changes(session)
+    if keys:
+        session.info.setdefault('availability_changes', set()).update(keys)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_availability(session):
+    bump_versions(session.info.pop('availability_changes', set()))
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_availability_changes(session):
+    session.info.pop('availability_changes', None)
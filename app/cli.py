@@ -0,0 +1,122 @@
+import click
+from sqlalchemy import inspect, UniqueConstraint
+from sqlalchemy.orm import selectinload
+
+from app import app, db
+from app.models import (Appointment, AppointmentService, Client, Entity, Staff,
+                        TYPEAHEAD_MODELS, get_tenant_index_columns)
+from app.search import get_backend, get_fulltext_models
+
+
+@app.cli.command('update-appointments')
+def update_appointments():
+    """Recalculate stored duration, cost and end time of appointments."""
+    query = Appointment.query.options(
+        selectinload(Appointment.appointment_services).selectinload(
+            AppointmentService.service))
+    count = 0
+    for appointment in query.yield_per(500):
+        for item in appointment.appointment_services:
+            if item.price is None:
+                item.price = item.service.price
+            if item.duration is None:
+                item.duration = item.service.duration
+        appointment.update_totals()
+        count += 1
+    db.session.commit()
+    click.echo('Updated {} appointments'.format(count))
+
+
+def get_expected_indexes(table, model=None):
+    expected = []
+    if model is not None and 'cid' in table.c:
+        expected.append(tuple(get_tenant_index_columns(model)))
+        for attr, _, search_type in model.search:
+            # flags are too coarse for an index of their own
+            if (attr in table.c and
+                    not issubclass(search_type, (str, bool)) and
+                    not table.c[attr].foreign_keys):
+                expected.append(('cid', 'no_active', attr))
+    for column in table.c:
+        if column.foreign_keys and column.name != 'cid':
+            expected.append((column.name,))
+    return list(dict.fromkeys(expected))
+
+
+def get_declared_indexes(table):
+    indexes = [tuple(c.name for c in index.columns) for index in table.indexes]
+    indexes.append(tuple(c.name for c in table.primary_key.columns))
+    indexes.extend(tuple(c.name for c in constraint.columns)
+                   for constraint in table.constraints
+                   if isinstance(constraint, UniqueConstraint))
+    return indexes
+
+
+def get_database_indexes(inspector, table_name):
+    indexes = [tuple(index['column_names'])
+               for index in inspector.get_indexes(table_name)]
+    indexes.append(tuple(
+        inspector.get_pk_constraint(table_name)['constrained_columns']))
+    indexes.extend(tuple(constraint['column_names']) for constraint in
+                   inspector.get_unique_constraints(table_name))
+    return indexes
+
+
+@app.cli.command('check-indexes')
+@click.option('--database', is_flag=True,
+              help='Check the database schema instead of the models.')
+def check_indexes(database):
+    """Report indexes missing for the filters and sorting of the models."""
+    models = {m.__tablename__: m for m in Entity.__subclasses__()
+              if hasattr(m, '__table__')}
+    inspector = inspect(db.engine) if database else None
+    missing = 0
+    for table in db.metadata.sorted_tables:
+        if inspector is None:
+            indexes = get_declared_indexes(table)
+        elif inspector.has_table(table.name):
+            indexes = get_database_indexes(inspector, table.name)
+        else:
+            click.echo('{}: table is missing'.format(table.name))
+            continue
+        for columns in get_expected_indexes(table, models.get(table.name)):
+            if not any(index[:len(columns)] == columns for index in indexes):
+                click.echo('{}: missing index ({})'.format(
+                    table.name, ', '.join(columns)))
+                missing += 1
+    click.echo('Missing indexes: {}'.format(missing))
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Create the full-text search index and fill it from the tables."""
+    with db.engine.begin() as connection:
+        backend = get_backend(connection)
+        backend.setup(connection)
+        for model in get_fulltext_models():
+            backend.rebuild(connection, model)
+            click.echo('Indexed {}'.format(model.__tablename__))
+
+
+@app.cli.command('update-phones')
+def update_phones():
+    """Fill the normalized phone columns of clients and staff."""
+    for model in (Client, Staff):
+        count = 0
+        for obj in model.query.yield_per(500):
+            obj.update_phone_index()
+            count += 1
+        db.session.commit()
+        click.echo('Updated {} {}'.format(count, model.__tablename__))
+
+
+@app.cli.command('update-names')
+def update_names():
+    """Fill the casefolded name columns used by the typeahead lookups."""
+    for model in TYPEAHEAD_MODELS.values():
+        count = 0
+        for obj in model.query.yield_per(500):
+            obj.update_name_index()
+            count += 1
+        db.session.commit()
+        click.echo('Updated {} {}'.format(count, model.__tablename__))
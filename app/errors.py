@@ -2,7 +2,7 @@ import logging
 import os
 from logging.handlers import SMTPHandler, RotatingFileHandler
 
-from flask import render_template, jsonify
+from flask import render_template, jsonify, request
 from werkzeug.http import HTTP_STATUS_CODES
 
 from app import db, app
@@ -10,6 +10,8 @@ from app import db, app
 
 @app.errorhandler(404)
 def not_found_error(error):
+    if request.path.startswith('/api/'):
+        return error_response(404, message=error.description)
     return render_template('404.html'), 404
 
 
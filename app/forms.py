@@ -1,12 +1,12 @@
 import string
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 import phonenumbers
-from flask import flash
+from flask import flash, url_for
 from flask_babel import lazy_gettext as _l
 from flask_wtf import FlaskForm, RecaptchaField
 from markupsafe import Markup
-from sqlalchemy import func
 from wtforms import (StringField, PasswordField, BooleanField,
                      SubmitField, TextAreaField, TelField, IntegerField,
                      FloatField, SelectField, DateField, TimeField,
@@ -16,8 +16,10 @@ from wtforms.validators import (DataRequired, Email, EqualTo,
                                 ValidationError, Length, Optional, NumberRange, InputRequired)
 
 import config
-from .functions import get_languages, get_free_time_intervals, get_interval_intersection, time_in_intervals
-from .models import Item, Week, Client, User, Staff, Location, Service, Appointment, ScheduleDay
+from .functions import get_languages, get_free_time_intervals, time_in_intervals
+from .intervals import IntervalSet
+from .models import (Item, Week, Client, User, Staff, Location, Service, Appointment,
+                     ScheduleDay, Entity, Period, Recurrence, normalize_phone)
 
 
 class BootstrapListWidget(widgets.ListWidget):
@@ -42,6 +44,37 @@ class MultiCheckboxField(SelectMultipleField):
     option_widget = widgets.CheckboxInput()
 
 
+class RemoteSelectField(SelectField):
+    # Renders the selected option only, the other options are loaded from
+    # the typeahead endpoint while typing
+
+    def __init__(self, label=None, validators=None, model=None, **kwargs):
+        kwargs.setdefault('coerce', int)
+        kwargs.setdefault('choices', [])
+        super(RemoteSelectField, self).__init__(label, validators, **kwargs)
+        self.model = model
+
+    def __call__(self, **kwargs):
+        kwargs.setdefault('data_typeahead',
+                          url_for('typeahead', name=self.model.__tablename__))
+        return super(RemoteSelectField, self).__call__(**kwargs)
+
+    def get_selected(self):
+        if not self.data:
+            return None
+        return self.model.get_object(self.data, mode_404=False)
+
+    def iter_choices(self):
+        selected = self.get_selected()
+        yield 0, _l('-Select-'), selected is None
+        if selected:
+            yield selected.id, selected.name, True
+
+    def pre_validate(self, form):
+        if self.data and self.get_selected() is None:
+            raise ValidationError(self.gettext('Not a valid choice.'))
+
+
 # global validators
 def validate_phone_global(form, field):
     try:
@@ -263,8 +296,8 @@ class StaffForm(FlaskForm):
         self.source_phone = source_phone
 
     def validate_phone(self, field):
-        if field.data != self.source_phone:
-            if Staff.find_object({'phone': field.data}):
+        if normalize_phone(field.data) != normalize_phone(self.source_phone):
+            if Staff.find_by_phone(field.data):
                 flash(_l('Please use a different phone'))
                 raise ValidationError(_l('Please use a different phone'))
 
@@ -341,8 +374,8 @@ class ClientForm(FlaskForm):
         self.source_phone = source_phone
 
     def validate_phone(self, field):
-        if field.data != self.source_phone:
-            if Client.find_object({'phone': field.data}):
+        if normalize_phone(field.data) != normalize_phone(self.source_phone):
+            if Client.find_by_phone(field.data):
                 flash(_l('Please use a different phone'))
                 raise ValidationError(_l('Please use a different phone'))
 
@@ -431,8 +464,8 @@ class AppointmentForm(FlaskForm):
     date = DateField(_l('Date'), validators=[validate_date_global],
                      format='%Y-%m-%d')
     time = SelectField(_l('Time'), choices=[], validate_choice=False)
-    client = SelectField(_l('Client'), choices=[], coerce=int,
-                         validators=[InputRequired()])
+    client = RemoteSelectField(_l('Client'), model=Client,
+                               validators=[InputRequired()])
     staff = SelectField(_l('Worker'), choices=[], coerce=int,
                         validators=[InputRequired()])
     service = SelectMultipleField(_l('Services'), choices=[],
@@ -442,11 +475,22 @@ class AppointmentForm(FlaskForm):
     no_check_duration = BooleanField(_l('Not control duration'))
     allow_booking_this_time = BooleanField(_l('Allow booking for this time'))
     info = TextAreaField(_l('Info'), validators=[Length(max=200)])
+    recurrence = SelectField(_l('Repeat'), choices=Recurrence.get_items(True),
+                             coerce=int, default=0)
+    repeat_interval = IntegerField(_l('Interval'), default=1,
+                                   validators=[NumberRange(min=1, max=365)])
+    repeat_count = IntegerField(_l('Number of repeats'), default=0,
+                                validators=[NumberRange(
+                                    min=0, max=Recurrence.max_count)])
     submit = SubmitField(_l('Submit'))
 
     def __init__(self, appointment=None, *args, **kwargs):
         super(AppointmentForm, self).__init__(*args, **kwargs)
         self.appointment = appointment
+        if appointment:
+            del self.recurrence
+            del self.repeat_interval
+            del self.repeat_count
 
     def validate_location(self, field):
         if not self.location.data:
@@ -475,21 +519,24 @@ class AppointmentForm(FlaskForm):
             flash(_l('Please select client'))
             raise ValidationError(_l('Please select client'))
         if self.date.data and self.time.data:
-            filter_param = dict(client_id=self.client.data)
-            search_param = [func.date(Appointment.date_time) == self.date.data]
-            if self.appointment:
-                search_param.append(Appointment.id != self.appointment.id)
-            appointments = Appointment.get_items(data_filter=filter_param,
-                                                 data_search=search_param)
-            client_intervals = []
             current_date_time = datetime.combine(self.date.data,
                                                  datetime.strptime(self.time.data,
                                                                    '%H:%M').time())
-            current_interval = [(current_date_time,
-                                 current_date_time + self.duration.data)]
-            for ap in appointments:
-                client_intervals.append((ap.date_time, ap.date_time + ap.duration))
-            if get_interval_intersection(client_intervals, current_interval):
+            current_time_end = current_date_time + self.duration.data
+            filter_param = dict(client_id=self.client.data)
+            search_param = [Appointment.date_time < current_time_end,
+                            Appointment.time_end > current_date_time]
+            if self.appointment:
+                search_param.append(Appointment.id != self.appointment.id)
+            appointments = Appointment.get_query(filter_param, search_param
+                                                 ).with_entities(
+                Appointment.date_time, Appointment.time_end)
+            origin = IntervalSet.for_day(self.date.data).origin
+            current_interval = IntervalSet(origin).add(
+                current_date_time, current_time_end, True)
+            client_intervals = IntervalSet.from_intervals(appointments, origin,
+                                                          outer=True)
+            if client_intervals.overlaps(current_interval):
                 flash(_l('Client is busy at this time'))
                 raise ValidationError(_l('Client is busy at this time'))
 
@@ -525,7 +572,7 @@ class AppointmentForm(FlaskForm):
         else:
             except_id = None
         intervals = get_free_time_intervals(location, date, staff, duration,
-                                            except_id)
+                                            except_id, cached=False)
         if not intervals:
             flash(_l('This time unavailable'))
             raise ValidationError(_l('This time unavailable'))
@@ -548,7 +595,43 @@ class ReceiptForm(FlaskForm):
 
 
 class SearchForm(FlaskForm):
-    pass
+    filter = HiddenField('filter')
+
+    def __init__(self, *args, hidden_args=None, **kwargs):
+        super(SearchForm, self).__init__(*args, **kwargs)
+        self.hidden_args = hidden_args or {}
+
+
+@lru_cache(maxsize=None)
+def get_search_form_class(class_object):
+    # Built once per model from its search metadata and never changed later,
+    # choices of select fields are set on each form instance
+    fields = {}
+    for search_attr, search_name, search_object in class_object.search:
+        if issubclass(search_object, Entity) and search_object.remote_choices:
+            fields[search_attr] = RemoteSelectField(_l(search_name),
+                                                    model=search_object)
+        elif issubclass(search_object, Entity) or issubclass(search_object, Week):
+            fields[search_attr] = SelectField(_l(search_name), choices=[],
+                                              coerce=int)
+        elif issubclass(search_object, bool) or issubclass(search_object,
+                                                           type(None)):
+            choices = [('', _l('-Select-')),
+                       ('False', _l('False')),
+                       ('True', _l('True'))]
+            fields[search_attr] = SelectField(_l(search_name), choices=choices,
+                                              coerce=str)
+        elif issubclass(search_object, type(datetime.now())):
+            fields[search_attr] = DateField(_l(search_name),
+                                            validators=[validate_date_global])
+        elif issubclass(search_object, Period):
+            fields[search_attr + '_from'] = DateField(
+                _l('Date from'), validators=[validate_date_global])
+            fields[search_attr + '_to'] = DateField(
+                _l('Date to'), validators=[validate_date_global])
+        else:
+            fields[search_attr] = StringField(_l(search_name))
+    return type(class_object.__name__ + 'SearchForm', (SearchForm,), fields)
 
 
 class ConfirmForm(FlaskForm):
@@ -610,8 +693,8 @@ class ContactUserForm(ContactForm):
 
 
 class NoticeForm(FlaskForm):
-    client = SelectField(_l('Client'), choices=[], coerce=int,
-                         validators=[InputRequired()])
+    client = RemoteSelectField(_l('Client'), model=Client,
+                               validators=[InputRequired()])
     date = DateField(_l('Date'), validators=[InputRequired()])
     description = TextAreaField(_l('Description'), validators=[DataRequired(),
                                                                Length(max=255)])
@@ -2,13 +2,19 @@ import os
 from datetime import datetime, timedelta
 from threading import Thread
 
-from flask import flash, session
+from flask import abort, flash, session
+from flask_login import current_user
 from flask_mail import Message
 from flask_babel import lazy_gettext as _l, _
-from sqlalchemy import func, inspect
+from sqlalchemy import inspect
+from sqlalchemy.orm import selectinload
 
-from app import app, mail
-from .models import Location, Staff, Service, Appointment, CompanyConfig
+from app import app, db, mail
+from .caching import (get_availability_keys, get_cached_availability,
+                      set_cached_availability)
+from .intervals import IntervalSet, get_day_start, get_free_intervals
+from .models import (Location, Staff, Service, Appointment, CompanyConfig,
+                     Client, Holiday, Schedule, Recurrence, get_date_range)
 
 
 def get_languages():
@@ -27,100 +33,390 @@ def get_duration(services):
     duration = 0
     if not services:
         return timedelta(minutes=duration)
+    services = [int(s) for s in services]
+    data_search = [Service.id.in_(set(services))]
+    durations = dict(Service.get_query(data_search=data_search).with_entities(
+        Service.id, Service.duration))
     for service_id in services:
-        service = Service.get_object(service_id)
-        duration += service.duration
+        if service_id not in durations:
+            abort(404, description='Service not found')
+        duration += durations[service_id] or 0
     return timedelta(minutes=duration)
 
 
-def get_interval_intersection(list_1, list_2):
-    if len(list_1) == 0 or len(list_2) == 0:
-        return []
-    time_list = []
-    for item in list_1:
-        time_list.append(('start', item[0], 1))
-        time_list.append(('end', item[1], 1))
-    for item in list_2:
-        time_list.append(('start', item[0], 2))
-        time_list.append(('end', item[1], 2))
-    time_list.sort(key=lambda x: x[1])
-    intervals = []
-    flag = ''
-    check = check_sum = 0
-    for time in time_list:
-        if not check:
-            check = time[2]
-        if not time[2] == check:
-            check = time[2]
-            check_sum += 1
-        if time[0] == flag:
-            prev_time = time
+def get_date_list(date_from, date_to=None):
+    if isinstance(date_from, datetime):
+        date_from = date_from.date()
+    if not date_to:
+        return [date_from]
+    if isinstance(date_to, datetime):
+        date_to = date_to.date()
+    dates = []
+    current_day = date_from
+    while current_day <= date_to:
+        dates.append(current_day)
+        current_day += timedelta(days=1)
+    return dates
+
+
+def get_location_schedules(location_ids=None):
+    data_search = []
+    if location_ids is not None:
+        data_search.append(Location.id.in_(location_ids))
+    items = Location.get_query(data_search=data_search).options(
+        selectinload(Location.services),
+        selectinload(Location.schedules).selectinload(Schedule.days))
+    return {loc.id: loc for loc in items}
+
+
+def get_staff_schedules(staff_ids):
+    data_search = [Staff.id.in_(staff_ids)]
+    items = Staff.get_query(data_search=data_search).options(
+        selectinload(Staff.schedules).selectinload(Schedule.days))
+    return {s.id: s for s in items}
+
+
+def get_staff_holidays(staff_ids, date_from, date_to):
+    data_search = [Holiday.staff_id.in_(staff_ids),
+                   *get_date_range(Holiday.date, date_from, date_to)]
+    holidays = {}
+    for holiday in Holiday.get_items(data_search=data_search):
+        holidays.setdefault((holiday.staff_id, holiday.date), holiday)
+    return holidays
+
+
+def get_staff_timetable(staff_ids, date_from, date_to, appointment_id=None):
+    data_filter = dict(cancel=False, allow_booking_this_time=False)
+    data_search = [Appointment.staff_id.in_(staff_ids),
+                   *get_date_range(Appointment.date_time, date_from, date_to)]
+    if appointment_id:
+        data_search.append(Appointment.id != appointment_id)
+    items = Appointment.get_query(data_filter, data_search).with_entities(
+        Appointment.staff_id, Appointment.date_time, Appointment.time_end)
+    timetable = {}
+    for staff_id, date_time, time_end in items:
+        key = (staff_id, date_time.date())
+        timetable.setdefault(key, []).append((date_time, time_end or date_time))
+    for intervals in timetable.values():
+        intervals.sort(key=lambda x: x[0])
+    return timetable
+
+
+def get_day_hours(date, location, staff, holiday, simple_mode=False):
+    # open hours of the location within the day, trimmed to the hours of the
+    # staff (holiday or schedule) unless simple_mode, starting not before now
+    day_start = get_day_start(date)
+    if not location.main_schedule:
+        return day_start, day_start
+    wt = location.main_schedule.get_work_time(date)
+    time_open, time_close = wt['hour_from'], wt['hour_to']
+    if not simple_mode:
+        if holiday:
+            wts = holiday.get_work_time()
+        elif staff.main_schedule:
+            wts = staff.main_schedule.get_work_time(date)
         else:
-            flag = time[0]
-            if flag == 'start':
-                prev_time = time
-            else:
-                intervals.append((prev_time[1], time[1]))
-    if check_sum == 1:
-        return []
-    return intervals
+            return day_start, day_start
+        time_open = max(time_open, wts['hour_from'])
+        time_close = min(time_close, wts['hour_to'])
+    return (max(time_open, day_start, datetime.now()),
+            min(time_close, day_start + timedelta(days=1)))
+
+
+def get_day_free_time(date, location, staff, holiday, timetable,
+                      simple_mode=False):
+    # free [start, end) runs of the day
+    time_open, time_close = get_day_hours(date, location, staff, holiday,
+                                          simple_mode)
+    return get_free_intervals(time_open, time_close, timetable)
+
+
+def get_day_free_intervals(date, location, staff, holiday, timetable,
+                           duration, simple_mode=False):
+    time_open, time_close = get_day_hours(date, location, staff, holiday,
+                                          simple_mode)
+    return get_free_intervals(time_open, time_close, timetable, duration)
+
+
+def get_free_time_intervals_bulk(location_id, dates, staff_ids, duration,
+                                 appointment_id=None, cached=True):
+    # cached=False recomputes the days (and refreshes their cache entries),
+    # used by the checks made right before an appointment is saved
+    if not location_id or not dates or not staff_ids or not duration:
+        return {}
+    if not isinstance(duration, type(timedelta(minutes=1))):
+        flash(_('Something went wrong...'))
+        return {}
+    dates = sorted(set(d.date() if isinstance(d, datetime) else d
+                       for d in dates))
+    staff_ids = sorted(set(int(s) for s in staff_ids))
+    keys = get_availability_keys(int(location_id), dates, staff_ids,
+                                 duration, appointment_id)
+    data = get_cached_availability(keys) if cached else {}
+    missing = [item for item in keys if item not in data]
+    if missing:
+        location = get_location_schedules([location_id]).get(int(location_id))
+        if not location:
+            abort(404, description='Location not found')
+        missing_staff = sorted(set(s for s, d in missing))
+        missing_dates = sorted(set(d for s, d in missing))
+        staff_list = get_staff_schedules(missing_staff)
+        holidays = get_staff_holidays(missing_staff, missing_dates[0],
+                                      missing_dates[-1])
+        timetable = get_staff_timetable(missing_staff, missing_dates[0],
+                                        missing_dates[-1], appointment_id)
+        simple_mode = CompanyConfig.get_parameter('simple_mode')
+        computed = {}
+        for staff_id, date in missing:
+            staff = staff_list.get(staff_id)
+            if not staff:
+                continue
+            key = (staff_id, date)
+            computed[key] = get_day_free_intervals(
+                date, location, staff, holidays.get(key),
+                timetable.get(key, []), duration, simple_mode)
+        set_cached_availability(keys, computed)
+        data.update(computed)
+    result = {}
+    for (staff_id, date), intervals in data.items():
+        result.setdefault(staff_id, {})[date] = intervals
+    return result
 
 
 def get_free_time_intervals(location_id, date, staff_id, duration,
-                            appointment_id=None):
+                            appointment_id=None, cached=True):
     if not location_id or not date or not staff_id or not duration:
         return []
     if not isinstance(duration, type(timedelta(minutes=1))):
         flash(_('Something went wrong...'))
         return []
-    location = Location.get_object(location_id)
-    time_open = datetime.strptime('00.00', '%H.%M')
-    time_close = datetime.strptime('00.00', '%H.%M')
-    if location.main_schedule:
-        wt = location.main_schedule.get_work_time(date)
-        time_open = wt['hour_from']
-        time_close = wt['hour_to']
-    staff_intervals = []
-    staff = Staff.get_object(staff_id)
-    if staff.main_schedule:
-        wts = staff.main_schedule.get_work_time(date)
-        if wts['hour_from'] == wts['hour_to']:
-            staff_intervals = []
+    date = get_date_list(date)[0]
+    result = get_free_time_intervals_bulk(location_id, [date], [staff_id],
+                                          duration, appointment_id, cached)
+    if int(staff_id) not in result:
+        abort(404, description='Staff not found')
+    return result[int(staff_id)][date]
+
+
+def get_free_staff(location_id, date_time, staff_ids, duration):
+    result = get_free_time_intervals_bulk(location_id, [date_time.date()],
+                                          staff_ids, duration)
+    return [staff_id for staff_id, days in result.items()
+            if time_in_intervals(date_time, days[date_time.date()])]
+
+
+def check_free_time_bulk(items):
+    # items are (location_id, staff_id, date_time, duration), an item is free
+    # if it fits the time left by the appointments and the items before it
+    if not items:
+        return []
+    staff_ids = sorted(set(staff_id for _, staff_id, _, _ in items))
+    dates = sorted(set(date_time.date() for _, _, date_time, _ in items))
+    locations = get_location_schedules(sorted(set(i[0] for i in items)))
+    staff_list = get_staff_schedules(staff_ids)
+    holidays = get_staff_holidays(staff_ids, dates[0], dates[-1])
+    timetable = get_staff_timetable(staff_ids, dates[0], dates[-1])
+    simple_mode = CompanyConfig.get_parameter('simple_mode')
+    free = {}
+    reserved = {}
+    result = []
+    for location_id, staff_id, date_time, duration in items:
+        location = locations.get(location_id)
+        staff = staff_list.get(staff_id)
+        if not location or not staff or not duration:
+            result.append(False)
+            continue
+        date = date_time.date()
+        if (location_id, staff_id, date) not in free:
+            free[(location_id, staff_id, date)] = IntervalSet(
+                get_day_start(date), intervals=get_day_free_time(
+                    date, location, staff, holidays.get((staff_id, date)),
+                    timetable.get((staff_id, date), []), simple_mode))
+        busy = reserved.setdefault((staff_id, date), IntervalSet.for_day(date))
+        day_free = free[(location_id, staff_id, date)] - busy
+        if day_free.fits(duration).contains(date_time):
+            busy.add(date_time, date_time + duration, outer=True)
+            result.append(True)
         else:
-            staff_from = max(wts['hour_from'], datetime.now())
-            staff_intervals = [(staff_from, wts['hour_to'])]
-    ht = staff.get_holiday_time(date)
-    if ht:
-        if ht['hour_from'] == ht['hour_to']:
-            staff_intervals = []
+            result.append(False)
+    return result
+
+
+def check_client_time_bulk(items):
+    # items are (client_id, date_time, duration), an item is free if the
+    # client has no appointment and no item before it at that time; the same
+    # check as AppointmentForm.validate_client with one query for all items
+    if not items:
+        return []
+    client_ids = sorted(set(client_id for client_id, _, _ in items))
+    time_from = min(date_time for _, date_time, _ in items)
+    time_to = max(date_time + duration for _, date_time, duration in items)
+    data_search = [Appointment.client_id.in_(client_ids),
+                   Appointment.date_time < time_to,
+                   Appointment.time_end > time_from]
+    appointments = Appointment.get_query(data_search=data_search).with_entities(
+        Appointment.client_id, Appointment.date_time, Appointment.time_end)
+    busy = {}
+    for client_id, date_time, time_end in appointments:
+        busy.setdefault(client_id, []).append((date_time, time_end))
+    result = []
+    for client_id, date_time, duration in items:
+        time_end = date_time + duration
+        intervals = busy.setdefault(client_id, [])
+        if any(start < time_end and end > date_time for start, end in intervals):
+            result.append(False)
         else:
-            staff_intervals = [(ht['hour_from'], ht['hour_to'])]
-    filter_param = dict(staff_id=staff_id, cancel=False,
-                        allow_booking_this_time=False)
-    search_param = [func.date(Appointment.date_time) == date]
-    if appointment_id:
-        search_param.append(Appointment.id != appointment_id)
-    timetable = Appointment.get_items(False, filter_param, search_param)
-    timetable.sort(key=lambda x: x.date_time)
-    intervals = []
-    time_from = max(time_open, datetime.now())
-    for appointment in timetable:
-        if appointment.time_end < datetime.now():
-            continue
-        time_to = appointment.date_time
-        interval = time_to - time_from
-        if interval >= duration:
-            intervals.append((time_from, time_to - duration))
-        time_from = appointment.time_end
-    interval = time_close - time_from
-    if interval >= duration:
-        intervals.append((time_from, time_close - duration))
-    intervals.sort(key=lambda x: x[0])
-    if CompanyConfig.get_parameter('simple_mode'):
-        return intervals
+            intervals.append((date_time, time_end))
+            result.append(True)
+    return result
+
+
+def create_appointments(items, check_free_time=True):
+    # items are dicts with location_id, staff_id, client_id, date_time and
+    # services (ids); returns the appointment or an error message per item
+    def get_objects(class_object, ids):
+        return {obj.id: obj for obj in class_object.get_objects(ids,
+                                                                mode_404=False)}
+
+    locations = get_objects(Location, [i['location_id'] for i in items])
+    staff_list = get_objects(Staff, [i['staff_id'] for i in items])
+    clients = get_objects(Client, [i['client_id'] for i in items])
+    services = get_objects(Service, [s for i in items for s in i['services']])
+    item_services = [list(dict.fromkeys(i['services'])) for i in items]
+    result = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        if item['location_id'] not in locations:
+            result[index] = 'Location not found'
+        elif item['staff_id'] not in staff_list:
+            result[index] = 'Staff not found'
+        elif item['client_id'] not in clients:
+            result[index] = 'Client not found'
+        elif not item_services[index]:
+            result[index] = 'Data must include services'
+        elif any(s not in services for s in item_services[index]):
+            result[index] = 'Service not found'
+        else:
+            valid.append(index)
+    durations = {i: timedelta(minutes=sum(services[s].duration or 0
+                                          for s in item_services[i]))
+                 for i in valid}
+    checks = check_client_time_bulk([
+        (items[i]['client_id'], items[i]['date_time'], durations[i])
+        for i in valid])
+    for index, free in zip(valid, checks):
+        if not free:
+            result[index] = 'Client is busy at this time'
+    valid = [index for index, free in zip(valid, checks) if free]
+    if check_free_time:
+        checks = check_free_time_bulk([
+            (items[i]['location_id'], items[i]['staff_id'],
+             items[i]['date_time'], durations[i])
+            for i in valid])
+        for index, free in zip(valid, checks):
+            if not free:
+                result[index] = 'No free time'
+        valid = [index for index, free in zip(valid, checks) if free]
+    for index in valid:
+        item = items[index]
+        appointment = Appointment(cid=current_user.cid,
+                                  location_id=item['location_id'],
+                                  date_time=item['date_time'],
+                                  client_id=item['client_id'],
+                                  staff_id=item['staff_id'],
+                                  info=item.get('info'))
+        db.session.add(appointment)
+        for service_id in item_services[index]:
+            appointment.add_service(services[service_id])
+        result[index] = appointment
+    db.session.flush()
+    return result
+
+
+def create_series(appointment, rule, count, interval=1, check_free_time=True):
+    # Repeats of the appointment checked in one pass, occurrences that can
+    # not be created are skipped and reported with the reason
+    dates = Recurrence.get_dates(rule, appointment.date_time, count, interval,
+                                 appointment.get_repeat_period())
+    items = [{'location_id': appointment.location_id,
+              'staff_id': appointment.staff_id,
+              'client_id': appointment.client_id,
+              'date_time': date_time,
+              'services': [s.service.id for s in appointment.appointment_services],
+              'info': appointment.info} for date_time in dates]
+    result = create_appointments(items, check_free_time)
+    created = [a for a in result if isinstance(a, Appointment)]
+    if created:
+        appointment.series_id = appointment.id
+        for item in created:
+            item.series_id = appointment.id
+    skipped = ['{} ({})'.format(d.strftime('%d.%m.%Y %H:%M'), _(a))
+               for d, a in zip(dates, result) if not isinstance(a, Appointment)]
+    flash(_('Repeats created: %(count)s', count=len(created)))
+    if skipped:
+        flash(_('Repeats not created: %(dates)s', dates=', '.join(skipped)))
+    return created
+
+
+def get_next_free_slots(services, count, days=14, location_id=None,
+                        staff_id=None, date_from=None):
+    if not services or not count or days < 1:
+        return []
+    duration = get_duration(services)
+    if not duration:
+        return []
+    if not date_from:
+        date_from = datetime.now().date()
+    dates = get_date_list(date_from, date_from + timedelta(days=days - 1))
+    location_ids = [location_id] if location_id else None
+    locations = [loc for loc in get_location_schedules(location_ids).values()
+                 if set(map(int, services)).issubset(
+                     {s.id for s in loc.services})]
+    if staff_id:
+        staff_ids = [int(staff_id)]
     else:
-        free_intervals = get_interval_intersection(intervals, staff_intervals)
-        return free_intervals
+        staff_ids = [s.id for s in Staff.get_items()]
+    if not locations or not staff_ids:
+        return []
+    staff_list = get_staff_schedules(staff_ids)
+    holidays = get_staff_holidays(staff_ids, dates[0], dates[-1])
+    simple_mode = CompanyConfig.get_parameter('simple_mode')
+    delta_config = CompanyConfig.get_parameter('min_time_interval')
+    slots = []
+    step = 7
+    for i in range(0, len(dates), step):
+        chunk = dates[i:i + step]
+        timetable = get_staff_timetable(staff_ids, chunk[0], chunk[-1])
+        for date in chunk:
+            for location in locations:
+                for sid, staff in staff_list.items():
+                    key = (sid, date)
+                    intervals = get_day_free_intervals(
+                        date, location, staff, holidays.get(key),
+                        timetable.get(key, []), duration, simple_mode)
+                    for dt in get_timeslots(intervals, delta_config):
+                        if time_in_intervals(dt, intervals):
+                            slots.append((dt, location.id, sid))
+            if len(slots) >= count:
+                slots.sort(key=lambda x: x[0])
+                return slots[:count]
+    slots.sort(key=lambda x: x[0])
+    return slots[:count]
+
+
+def get_timeslots(intervals, delta_config):
+    timeslots = []
+    delta = timedelta(minutes=delta_config)
+    for interval in intervals:
+        start = interval[0] + timedelta(minutes=4)
+        start = start - timedelta(minutes=start.minute % delta_config,
+                                  seconds=start.second,
+                                  microseconds=start.microsecond)
+        timeslots.append(start)
+        while start < interval[1]:
+            start = start + delta
+            timeslots.append(start)
+    return timeslots
 
 
 def time_in_intervals(dt, intervals):
@@ -183,18 +479,22 @@ def get_calendar(days=None, data_filter=None, day_start=None):
         day_end = current_day + timedelta(days=31)
     else:
         day_end = current_day + timedelta(days=days)
+    data_search = get_date_range(Appointment.date_time, current_day,
+                                 day_end - timedelta(days=1))
+    appointments = Appointment.get_query(data_filter, data_search).with_entities(
+        Appointment.date_time, Appointment.time_end, Appointment.staff_id)
     calendar = {}
     while current_day < day_end:
-        data_search = [func.date(Appointment.date_time) == current_day]
-        appointments = Appointment.get_items(False, data_filter=data_filter,
-                                             data_search=data_search)
-        appointments_list = (
-            [(a.date_time, a.date_time + a.duration, a.staff) for a in appointments])
-        appointments_list.sort(key=lambda x: x[0])
-        day = {'count': len(appointments_list),
-               'appointments': appointments_list}
-        calendar[current_day] = day
+        calendar[current_day] = {'count': 0, 'appointments': []}
         current_day += timedelta(days=1)
+    for date_time, time_end, staff_id in appointments:
+        day = calendar.get(date_time.date())
+        if day is None:
+            continue
+        day['appointments'].append((date_time, time_end, staff_id))
+        day['count'] += 1
+    for day in calendar.values():
+        day['appointments'].sort(key=lambda x: x[0])
     return calendar
 
 
@@ -0,0 +1,211 @@
+from datetime import datetime, timedelta, time
+
+DAY = timedelta(days=1)
+MINUTE = timedelta(minutes=1)
+ZERO = timedelta()
+
+
+# Free or busy time of one day as sorted, disjoint [start, end) intervals,
+# the same lists the old sweep worked on. Bounds are whole resolution
+# minutes from origin (busy time rounds outwards, free time inwards) and
+# stay within the day, so the datetimes are compared as they are
+class IntervalSet:
+    __slots__ = ('origin', 'resolution', 'step', 'end', 'intervals')
+
+    def __init__(self, origin, resolution=1, intervals=None):
+        self.origin = origin
+        self.resolution = resolution
+        self.step = MINUTE if resolution == 1 else timedelta(minutes=resolution)
+        self.end = origin + DAY
+        self.intervals = intervals or []
+
+    def __repr__(self):
+        return '<IntervalSet {} {}>'.format(self.origin, self.intervals)
+
+    def __bool__(self):
+        return bool(self.intervals)
+
+    def __eq__(self, other):
+        return (isinstance(other, IntervalSet) and
+                self.origin == other.origin and
+                self.resolution == other.resolution and
+                self.intervals == other.intervals)
+
+    def __and__(self, other):
+        intervals = []
+        items, other_items = self.intervals, other.intervals
+        i = j = 0
+        while i < len(items) and j < len(other_items):
+            start, end = items[i]
+            other_start, other_end = other_items[j]
+            if other_start > start:
+                start = other_start
+            if end < other_end:
+                i += 1
+            else:
+                end = other_end
+                j += 1
+            if start < end:
+                intervals.append((start, end))
+        return self._copy(intervals)
+
+    def __or__(self, other):
+        return self._copy(merge(sorted(self.intervals + other.intervals)))
+
+    def __sub__(self, other):
+        intervals = []
+        other_items = other.intervals
+        j = 0
+        for start, end in self.intervals:
+            while j < len(other_items) and other_items[j][1] <= start:
+                j += 1
+            k = j
+            while k < len(other_items) and other_items[k][0] < end:
+                if other_items[k][0] > start:
+                    intervals.append((start, other_items[k][0]))
+                start = max(start, other_items[k][1])
+                k += 1
+            if start < end:
+                intervals.append((start, end))
+        return self._copy(intervals)
+
+    @classmethod
+    def for_day(cls, date, resolution=1):
+        return cls(get_day_start(date), resolution)
+
+    @classmethod
+    def from_intervals(cls, intervals, origin, resolution=1, outer=False,
+                       closed=False):
+        interval_set = cls(origin, resolution)
+        clip = interval_set._clip
+        step = interval_set.step
+        items = []
+        for start, end in intervals:
+            item = clip(start, end + step if closed else end, outer)
+            if item:
+                items.append(item)
+        items.sort()
+        interval_set.intervals = merge(items)
+        return interval_set
+
+    def _copy(self, intervals):
+        interval_set = IntervalSet.__new__(IntervalSet)
+        interval_set.origin = self.origin
+        interval_set.resolution = self.resolution
+        interval_set.step = self.step
+        interval_set.end = self.end
+        interval_set.intervals = intervals
+        return interval_set
+
+    def _round(self, dt, ceil=False):
+        rest = dt.minute % self.resolution
+        if not (rest or dt.second or dt.microsecond):
+            return dt
+        dt = dt.replace(second=0, microsecond=0) - timedelta(minutes=rest)
+        return dt + self.step if ceil else dt
+
+    def _clip(self, start, end, outer=False):
+        # outer=True rounds outwards (busy time), otherwise inwards (free time)
+        if start.second or start.microsecond or self.resolution != 1:
+            start = self._round(start, not outer)
+        if end.second or end.microsecond or self.resolution != 1:
+            end = self._round(end, outer)
+        if start < self.origin:
+            start = self.origin
+        if end > self.end:
+            end = self.end
+        if start < end:
+            return start, end
+        return None
+
+    def add(self, start, end, outer=False):
+        item = self._clip(start, end, outer)
+        if item and self.intervals:
+            self.intervals = merge(sorted(self.intervals + [item]))
+        elif item:
+            self.intervals = [item]
+        return self
+
+    def contains(self, dt):
+        for start, end in self.intervals:
+            if start <= dt < end:
+                return True
+        return False
+
+    def overlaps(self, other):
+        return bool(self & other)
+
+    def fits(self, duration):
+        # start slots followed by a free run long enough for the duration
+        if duration <= ZERO:
+            return self._copy(list(self.intervals))
+        if duration.microseconds or duration.seconds % (60 * self.resolution):
+            duration = (duration // self.step + 1) * self.step
+        shift = duration - self.step
+        return self._copy([(start, end - shift) for start, end in self.intervals
+                           if end - start >= duration])
+
+    def to_intervals(self):
+        return list(self.intervals)
+
+    def to_start_intervals(self):
+        return [(start, end - self.step) for start, end in self.intervals]
+
+
+def merge(intervals):
+    # sorted intervals with touching or overlapping ones joined
+    result = []
+    for start, end in intervals:
+        if result and start <= result[-1][1]:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
+        else:
+            result.append((start, end))
+    return result
+
+
+def get_day_start(date):
+    if isinstance(date, datetime):
+        date = date.date()
+    return datetime.combine(date, time())
+
+
+def floor_minute(dt):
+    if dt.second or dt.microsecond:
+        return dt.replace(second=0, microsecond=0)
+    return dt
+
+
+def ceil_minute(dt):
+    if dt.second or dt.microsecond:
+        return dt.replace(second=0, microsecond=0) + MINUTE
+    return dt
+
+
+def get_free_intervals(time_open, time_close, timetable, duration=ZERO):
+    # Closed ranges of start times between time_open and time_close that fit
+    # the duration around the timetable (sorted by start) in one sweep, the
+    # availability hot path; with no duration these are the free [start, end)
+    # runs. Free time rounds inwards and busy time outwards to whole minutes,
+    # an appointment inside a longer one does not end the busy time early
+    if duration.microseconds or duration.seconds % 60:
+        duration = (duration // MINUTE + 1) * MINUTE
+    intervals = []
+    time_from = ceil_minute(time_open)
+    time_close = floor_minute(time_close)
+    for start, end in timetable:
+        if start >= time_close:
+            break
+        if start.second or start.microsecond:
+            start = start.replace(second=0, microsecond=0)
+        if end.second or end.microsecond:
+            end = end.replace(second=0, microsecond=0) + MINUTE
+        if end <= start:
+            continue
+        if start > time_from and start - time_from >= duration:
+            intervals.append((time_from, start - duration))
+        if end > time_from:
+            time_from = end
+    if time_close > time_from and time_close - time_from >= duration:
+        intervals.append((time_from, time_close - duration))
+    return intervals
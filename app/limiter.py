@@ -0,0 +1,128 @@
+import math
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import g, request
+
+from app import app
+from app.errors import error_response
+from app.models import Company
+
+# Token buckets for /api/ requests, checked before authentication so that a
+# throttled request costs no database work. The limits of a token are learned
+# after its first authenticated request: the bucket is shared by the tenant
+# and sized by the tariff (requests per minute and burst, when the tariff has
+# the api option). Requests with tokens that are not known yet share the
+# default bucket of their address, so rotating tokens or guessing
+# credentials does not open new buckets. Behind a reverse proxy the address
+# is only the client's with PROXY_COUNT set in the config.
+API_PREFIX = '/api/'
+DEFAULT_RATE_LIMIT = 60
+DEFAULT_BURST = 20
+POLICY_TIMEOUT = 300
+MAX_KEYS = 10000
+
+
+class MemoryStore:
+    # Buckets of this process; a shared store only has to provide take()
+
+    def __init__(self, size=MAX_KEYS):
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def take(self, key, rate, burst):
+        # rate is in tokens per second; returns whether a token was taken,
+        # the tokens left and the seconds until the bucket is full again
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return allowed, int(tokens), (burst - tokens) / rate
+
+
+class Limiter:
+
+    def __init__(self, store=None):
+        self.store = store or MemoryStore()
+        self.policies = OrderedDict()
+        self.lock = Lock()
+
+    def get_policy(self, token):
+        with self.lock:
+            policy = self.policies.get(token)
+            if policy is not None and policy[3] > time.monotonic():
+                return policy[:3]
+        return None
+
+    def has_policy(self, token):
+        return self.get_policy(token) is not None
+
+    def set_policy(self, token, cid, tariff):
+        rate_limit, burst = DEFAULT_RATE_LIMIT, DEFAULT_BURST
+        if tariff and tariff.api:
+            rate_limit = tariff.api_rate_limit or rate_limit
+            burst = tariff.api_burst or burst
+        with self.lock:
+            self.policies[token] = (('cid', cid), rate_limit, burst,
+                                    time.monotonic() + POLICY_TIMEOUT)
+            self.policies.move_to_end(token)
+            while len(self.policies) > MAX_KEYS:
+                self.policies.popitem(last=False)
+
+    def check(self, token, address):
+        policy = self.get_policy(token) if token else None
+        if policy is None:
+            policy = ('address', address), DEFAULT_RATE_LIMIT, DEFAULT_BURST
+        key, rate_limit, burst = policy
+        allowed, remaining, reset = self.store.take(key, rate_limit / 60, burst)
+        headers = {'X-RateLimit-Limit': str(rate_limit),
+                   'X-RateLimit-Remaining': str(remaining),
+                   'X-RateLimit-Reset': str(math.ceil(reset))}
+        if not allowed:
+            headers['Retry-After'] = str(math.ceil(60 / rate_limit))
+        return allowed, headers
+
+
+limiter = Limiter()
+
+
+def get_request_token():
+    auth = request.headers.get('Authorization', '').split(None, 1)
+    if len(auth) == 2:
+        return auth[1]
+    return None
+
+
+@app.before_request
+def check_rate_limit():
+    if not request.path.startswith(API_PREFIX):
+        return None
+    allowed, g.rate_limit_headers = limiter.check(get_request_token(),
+                                                  request.remote_addr)
+    if not allowed:
+        response = error_response(429, message='Too many requests')
+        response.headers.update(g.rate_limit_headers)
+        return response
+    return None
+
+
+@app.after_request
+def add_rate_limit_headers(response):
+    if 'rate_limit_headers' not in g or response.status_code == 429:
+        return response
+    response.headers.update(g.rate_limit_headers)
+    token = get_request_token()
+    user = g.get('current_user')
+    if (user and token and not limiter.has_policy(token) and
+            user.token == token):
+        limiter.set_policy(token, user.cid, Company.get_current_tariff())
+    return response
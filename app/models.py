@@ -1,19 +1,42 @@
 import base64
+import json
 import os
 import string
+import sys
 import uuid
 from dataclasses import dataclass
 from random import choice
 
-from flask import abort, flash
+import phonenumbers
+from flask import abort, flash, g, has_request_context
 from flask_babel import lazy_gettext as _l
 from flask_login import UserMixin, current_user
 from flask_security import RoleMixin
-from sqlalchemy import func, inspect, extract
+from flask_sqlalchemy import Pagination
+from sqlalchemy import func, inspect, distinct, and_, or_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import declared_attr, ONETOMANY, MANYTOMANY
 from werkzeug.security import generate_password_hash, check_password_hash
-from app import db, login, app
-from datetime import datetime, timedelta
+from app import db, login, app, cache
+from .versions import make_key, get_versions, bump_versions
+from datetime import datetime, timedelta, date
+
+COUNT_ESTIMATE_TIMEOUT = 300
+CHOICES_TIMEOUT = 3600
+PHONE_CHARACTERS = '+0123456789 -()'
+# Casefolded names are compared by code point, PostgreSQL needs the C
+# collation for that, SQLite compares binary by default
+FOLDED_NAME = db.String(255).with_variant(
+    postgresql.VARCHAR(255, collation='C'), 'postgresql')
+
+
+def get_request_cache(name):
+    if not has_request_context():
+        return None
+    if name not in g:
+        setattr(g, name, {})
+    return getattr(g, name)
 
 
 @login.user_loader
@@ -29,18 +52,8 @@ services_locations = db.Table('services_locations',
                               db.Column('location_id',
                                         db.Integer,
                                         db.ForeignKey('location.id'),
-                                        primary_key=True))
-
-appointments_services = db.Table('appointments_services',
-                                 db.Column('appointment_id',
-                                           db.Integer,
-                                           db.ForeignKey('appointment.id'),
-                                           primary_key=True),
-                                 db.Column('service_id',
-                                           db.Integer,
-                                           db.ForeignKey('service.id'),
-                                           primary_key=True))
-
+                                        primary_key=True,
+                                        index=True))
 
 roles_users = db.Table('roles_users',
                        db.Column('role_id',
@@ -50,7 +63,8 @@ roles_users = db.Table('roles_users',
                        db.Column('user_id',
                                  db.Integer,
                                  db.ForeignKey('user.id'),
-                                 primary_key=True))
+                                 primary_key=True,
+                                 index=True))
 
 
 roles_permissions = db.Table('roles_permissions',
@@ -61,7 +75,8 @@ roles_permissions = db.Table('roles_permissions',
                              db.Column('permission_id',
                                        db.Integer,
                                        db.ForeignKey('permission.id'),
-                                       primary_key=True))
+                                       primary_key=True,
+                                       index=True))
 
 
 clients_tags = db.Table('clients_tags',
@@ -72,7 +87,8 @@ clients_tags = db.Table('clients_tags',
                         db.Column('tag_id',
                                   db.Integer,
                                   db.ForeignKey('tag.id'),
-                                  primary_key=True))
+                                  primary_key=True,
+                                  index=True))
 
 staff_schedules = db.Table('staff_schedules',
                            db.Column('staff_id',
@@ -82,7 +98,8 @@ staff_schedules = db.Table('staff_schedules',
                            db.Column('schedule_id',
                                      db.Integer,
                                      db.ForeignKey('schedule.id'),
-                                     primary_key=True))
+                                     primary_key=True,
+                                     index=True))
 
 locations_schedules = db.Table('locations_schedules',
                                db.Column('location_id',
@@ -92,19 +109,23 @@ locations_schedules = db.Table('locations_schedules',
                                db.Column('schedule_id',
                                          db.Integer,
                                          db.ForeignKey('schedule.id'),
-                                         primary_key=True))
+                                         primary_key=True,
+                                         index=True))
 
 
 class Entity:
     table_link = 'index'
     sort = 'id'
     sort_mode = 'asc'
+    remote_choices = False
     search = []
+    # tenant key and lookup columns kept by the indexes, not exposed by the API
+    private_fields = ('cid', 'name_fold', 'phone_norm', 'phone_rev')
     id = db.Column(db.Integer, primary_key=True)
     no_active = db.Column(db.Boolean, default=False)
-    timestamp_create = db.Column(db.DateTime(), default=datetime.utcnow())
-    timestamp_update = db.Column(db.DateTime(), default=datetime.utcnow(),
-                                 onupdate=datetime.utcnow())
+    timestamp_create = db.Column(db.DateTime(), default=datetime.utcnow)
+    timestamp_update = db.Column(db.DateTime(), default=datetime.utcnow,
+                                 onupdate=datetime.utcnow)
 
     @staticmethod
     def get_class(class_name):
@@ -121,7 +142,8 @@ class Entity:
         return list(c.__name__ for c in cls.__subclasses__())
 
     @classmethod
-    def get_items(cls, tuple_mode=False, data_filter=None, data_search=None, overall=False):
+    def get_query(cls, data_filter=None, data_search=None, overall=False,
+                  options=None):
         if overall:
             param = {'no_active': False}
         else:
@@ -131,55 +153,228 @@ class Entity:
         items = cls.query.filter_by(**param)
         if data_search:
             items = items.filter(*data_search)
+        if options:
+            items = items.options(*options)
         if cls.sort_mode == 'asc':
             items = items.order_by(getattr(cls, cls.sort).asc())
         else:
             items = items.order_by(getattr(cls, cls.sort).desc())
+        return items
+
+    @classmethod
+    def get_items(cls, tuple_mode=False, data_filter=None, data_search=None, overall=False,
+                  options=None):
         if tuple_mode:
-            items = [(i.id, i.name) for i in items]
+            items = cls.get_choices(data_filter, data_search, overall)
             if not len(items) == 1:
                 items.insert(0, (0, _l('-Select-')))
         else:
+            items = cls.get_query(data_filter, data_search, overall, options)
             items = [i for i in items]
         return items
 
     @classmethod
-    def get_pagination(cls, page, data_filter=None, data_search=None):
-        param = {'cid': current_user.cid, 'no_active': False}
-        if data_filter:
-            param = {**param, **data_filter}
-        items = cls.query.filter_by(**param)
-        if data_search:
-            items = items.filter(*data_search)
-        if cls.sort_mode == 'asc':
-            items = items.order_by(getattr(cls, cls.sort).asc())
-        else:
-            items = items.order_by(getattr(cls, cls.sort).desc())
-        items = items.paginate(page, app.config['ROWS_PER_PAGE'], False)
-        return items
+    def get_choices(cls, data_filter=None, data_search=None, overall=False):
+        # Plain (id, name) rows, cached per tenant unless filtered by SQL
+        # conditions; the version is bumped when names of the table change
+        key = None
+        if not data_search and has_request_context():
+            cid = None if overall else current_user.cid
+            scope = ('choices', cid, cls.__tablename__)
+            version = get_versions([scope])[scope]
+            key = make_key(*scope, version, sorted((data_filter or {}).items()))
+            items = cache.get(key)
+            if items is not None:
+                return list(items)
+        items = cls.get_query(data_filter, data_search, overall)
+        items = [(id, name) for id, name in items.with_entities(cls.id, cls.name)]
+        if key:
+            cache.set(key, items, timeout=CHOICES_TIMEOUT)
+        return list(items)
 
     @classmethod
-    def get_object(cls, id, mode_404=True, overall=False):
-        if overall:
-            param = {'no_active': False, 'id': id}
+    def get_columns(cls, fields=None):
+        # Public mapped columns by name with id always first, None for unknown
+        # or private names
+        columns = inspect(cls).columns
+        if not fields:
+            return [c for c in columns if c.key not in cls.private_fields]
+        if any(field not in columns or field in cls.private_fields
+               for field in fields):
+            return None
+        return [columns['id'], *[columns[field] for field in dict.fromkeys(fields)
+                                 if field != 'id']]
+
+    @classmethod
+    def get_rows(cls, after_id=None, limit=100, columns=None, data_search=None):
+        # Column-only rows in id order, the next page starts after the last id
+        search = list(data_search or [])
+        if after_id:
+            search.append(cls.id > after_id)
+        columns = columns or cls.get_columns()
+        items = cls.get_query(data_search=search).order_by(None).order_by(
+            cls.id.asc()).with_entities(*columns).limit(limit + 1)
+        rows = [dict(zip([c.name for c in columns], row)) for row in items]
+        return rows[:limit], len(rows) > limit
+
+    @classmethod
+    def get_pagination(cls, page, data_filter=None, data_search=None, count=False,
+                       options=None):
+        per_page = app.config['ROWS_PER_PAGE']
+        items = cls.get_query(data_filter, data_search, options=options)
+        if count:
+            return items.paginate(page, per_page, False)
+        page = max(page, 1)
+        rows = items.limit(per_page + 1).offset((page - 1) * per_page).all()
+        total = None
+        if not data_filter and not data_search:
+            total = cls.get_count_estimate()
+        return CountFreePagination(items, page, per_page, total,
+                                   rows[:per_page], len(rows) > per_page)
+
+    @classmethod
+    def get_count_estimate(cls):
+        key = 'count:{}:{}'.format(cls.__name__, current_user.cid)
+        total = cache.get(key)
+        if total is None:
+            total = cls.get_query().order_by(None).count()
+            cache.set(key, total, timeout=COUNT_ESTIMATE_TIMEOUT)
+        return total
+
+    @classmethod
+    def get_keyset_pagination(cls, cursor=None, data_filter=None, data_search=None,
+                              options=None):
+        # Seek by (sort, id) from the cursor row instead of OFFSET
+        per_page = app.config['ROWS_PER_PAGE']
+        sort_column = getattr(cls, cls.sort)
+        key = cls.decode_cursor(cursor) if cursor else None
+        backward = key is not None and key[2] == 'prev'
+        descending = (cls.sort_mode != 'asc') != backward
+        items = cls.get_query(data_filter, data_search,
+                              options=options).order_by(None)
+        if key:
+            value, id = key[:2]
+            if descending:
+                items = items.filter(or_(sort_column < value,
+                                         and_(sort_column == value, cls.id < id)))
+            else:
+                items = items.filter(or_(sort_column > value,
+                                         and_(sort_column == value, cls.id > id)))
+        if descending:
+            items = items.order_by(sort_column.desc(), cls.id.desc())
         else:
-            param = {'cid': current_user.cid, 'no_active': False, 'id': id}
-        if mode_404:
-            obj = cls.query.filter_by(**param).first_or_404()
+            items = items.order_by(sort_column.asc(), cls.id.asc())
+        items = items.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backward:
+            items.reverse()
+            has_prev, has_next = more, True
         else:
+            has_prev, has_next = key is not None, more
+        prev_cursor = next_cursor = None
+        if items and has_prev:
+            prev_cursor = cls.encode_cursor(items[0], 'prev')
+        if items and has_next:
+            next_cursor = cls.encode_cursor(items[-1], 'next')
+        return KeysetPagination(items, prev_cursor, next_cursor)
+
+    @classmethod
+    def encode_cursor(cls, obj, direction):
+        value = getattr(obj, cls.sort)
+        if isinstance(value, date):
+            value = value.isoformat()
+        data = json.dumps([value, obj.id, direction]).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            value, id, direction = json.loads(data)
+            column_type = getattr(cls, cls.sort).type
+            if isinstance(column_type, db.DateTime):
+                value = datetime.fromisoformat(value)
+            elif isinstance(column_type, db.Date):
+                value = date.fromisoformat(value)
+            if direction not in ('prev', 'next'):
+                return None
+            return value, int(id), direction
+        except (ValueError, TypeError):
+            return None
+
+    @classmethod
+    def get_object_param(cls, overall=False):
+        if overall:
+            return {'no_active': False}
+        return {'cid': current_user.cid, 'no_active': False}
+
+    @classmethod
+    def get_cached_object(cls, param):
+        # Objects already loaded in this request, the query would go
+        # around the identity map because of the cid/no_active filter
+        objects = get_request_cache('objects')
+        if objects is None:
+            return None
+        key = (cls, tuple(sorted((k, str(v)) for k, v in param.items())))
+        obj = objects.get(key)
+        if obj is None or not inspect(obj).persistent:
+            return None
+        for k, v in param.items():
+            if str(getattr(obj, k)) != str(v):
+                return None
+        return obj
+
+    @classmethod
+    def set_cached_object(cls, param, obj):
+        objects = get_request_cache('objects')
+        if objects is not None and obj is not None:
+            key = (cls, tuple(sorted((k, str(v)) for k, v in param.items())))
+            objects[key] = obj
+
+    @classmethod
+    def get_object(cls, id, mode_404=True, overall=False):
+        param = {**cls.get_object_param(overall), 'id': id}
+        obj = cls.get_cached_object(param)
+        if obj is None:
             obj = cls.query.filter_by(**param).first()
+            cls.set_cached_object(param, obj)
+        if obj is None and mode_404:
+            abort(404)
         return obj
 
+    @classmethod
+    def get_objects(cls, ids, mode_404=True, overall=False):
+        try:
+            ids = [int(id) for id in ids]
+        except (TypeError, ValueError):
+            if mode_404:
+                abort(404)
+            return []
+        param = cls.get_object_param(overall)
+        objects = {}
+        for id in set(ids):
+            obj = cls.get_cached_object({**param, 'id': id})
+            if obj is not None:
+                objects[id] = obj
+        missing = set(ids).difference(objects)
+        if missing:
+            for obj in cls.query.filter_by(**param).filter(cls.id.in_(missing)):
+                objects[obj.id] = obj
+                cls.set_cached_object({**param, 'id': obj.id}, obj)
+        if mode_404 and len(objects) < len(set(ids)):
+            abort(404)
+        return [objects[id] for id in ids if id in objects]
+
     @classmethod
     def find_object(cls, data_filter, mode_404=False, overall=False):
-        if overall:
-            param = {'no_active': False, **data_filter}
-        else:
-            param = {'cid': current_user.cid, 'no_active': False, **data_filter}
-        if mode_404:
-            obj = cls.query.filter_by(**param).first_or_404()
-        else:
+        param = {**cls.get_object_param(overall), **data_filter}
+        obj = cls.get_cached_object(param)
+        if obj is None:
             obj = cls.query.filter_by(**param).first()
+            cls.set_cached_object(param, obj)
+        if obj is None and mode_404:
+            abort(404)
         return obj
 
     def delete_object(self, silent_mode=False):
@@ -215,12 +410,163 @@ class Splitter:
         return db.Column(db.Integer, db.ForeignKey('company.id'), nullable=False)
 
 
+class CountFreePagination(Pagination):
+    # total is None or a cached estimate, the next page is found by an extra row
+
+    def __init__(self, query, page, per_page, total, items, next_available):
+        super(CountFreePagination, self).__init__(query, page, per_page, total,
+                                                  items)
+        self.next_available = next_available
+
+    @property
+    def has_next(self):
+        return self.next_available
+
+
+class KeysetPagination:
+    keyset = True
+
+    def __init__(self, items, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+class FullText(str):
+    # Search type of string fields kept in the full-text search index
+    pass
+
+
+def normalize_phone(number):
+    # E.164 form of the number or None if it can not be parsed
+    if not number:
+        return None
+    number = str(number).strip()
+    if not number.startswith('+'):
+        number = '+' + number
+    try:
+        p = phonenumbers.parse(number)
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return None
+    return phonenumbers.format_number(p, phonenumbers.PhoneNumberFormat.E164)
+
+
+def get_prefix_range(column, prefix):
+    # Range for LIKE 'prefix%' that an index can serve, the upper bound is
+    # the prefix with its last character incremented. Digits (after a '+')
+    # carry instead (4329 -> 433), so phone numbers compare the same in any
+    # collation; other text needs a column compared by code point
+    conditions = [column >= prefix]
+    number = prefix[1:] if prefix.startswith('+') else prefix
+    if number and all(c in string.digits for c in number):
+        head = number.rstrip('9')
+        head = prefix[:-len(number)] + head if head else ''
+    else:
+        head = prefix.rstrip(chr(sys.maxunicode))
+    if head:
+        conditions.append(column < head[:-1] + chr(ord(head[-1]) + 1))
+    return conditions
+
+
+class NameIndex:
+    # name_fold (casefolded name) serves typeahead prefix lookups with a
+    # plain range, kept up to date by update_name_index before flush
+
+    @declared_attr
+    def name_fold(self):
+        return db.Column(FOLDED_NAME)
+
+    def update_name_index(self):
+        self.name_fold = self.name.casefold() if self.name else None
+
+    @classmethod
+    def get_typeahead(cls, prefix, limit=20, data_search=None):
+        # Case-insensitive name prefix, casefold also covers non-ASCII names
+        # that lower() in SQLite leaves as they are
+        search = get_prefix_range(cls.name_fold, prefix.strip().casefold())
+        if data_search:
+            search.extend(data_search)
+        items = cls.get_query(data_search=search).with_entities(cls.id, cls.name)
+        return [{'id': id, 'name': name} for id, name in items.limit(limit)]
+
+
+class PhoneIndex:
+    # phone_norm (E.164) serves duplicate checks and prefix lookups,
+    # phone_rev (reversed digits) serves "last digits" lookups,
+    # both are kept up to date by update_phone_index before flush
+
+    @declared_attr
+    def phone_norm(self):
+        return db.Column(db.String(16))
+
+    @declared_attr
+    def phone_rev(self):
+        return db.Column(db.String(16))
+
+    @declared_attr
+    def __table_args__(cls):
+        return (db.Index('ix_{}_cid_phone_norm'.format(cls.__tablename__),
+                         'cid', 'phone_norm'),
+                db.Index('ix_{}_cid_phone_rev'.format(cls.__tablename__),
+                         'cid', 'phone_rev'))
+
+    def update_phone_index(self):
+        self.phone_norm = normalize_phone(self.phone)
+        self.phone_rev = self.phone_norm[:0:-1] if self.phone_norm else None
+
+    @classmethod
+    def find_by_phone(cls, number):
+        phone_norm = normalize_phone(number)
+        if not phone_norm:
+            return cls.find_object({'phone': number})
+        return cls.find_object({'phone_norm': phone_norm})
+
+    @classmethod
+    def get_phone_condition(cls, term):
+        term = term.strip()
+        digits = ''.join(c for c in term if c.isdigit())
+        if not digits or set(term) - set(PHONE_CHARACTERS):
+            return None
+        if term.startswith('+'):
+            return and_(*get_prefix_range(cls.phone_norm, '+' + digits))
+        return and_(*get_prefix_range(cls.phone_rev, digits[::-1]))
+
+
 @dataclass
 class Period:
     date_from: datetime
     date_to: datetime
 
 
+def get_date_range(column, date_from=None, date_to=None):
+    # Inclusive range of days as plain comparisons, so an index on the column
+    # can be used (func.date(column) == date can not)
+    search = []
+    is_datetime = isinstance(column.type, db.DateTime)
+    if date_from is not None:
+        if isinstance(date_from, datetime):
+            date_from = date_from.date()
+        if is_datetime:
+            date_from = datetime.combine(date_from, datetime.min.time())
+        search.append(column >= date_from)
+    if date_to is not None:
+        if isinstance(date_to, datetime):
+            date_to = date_to.date()
+        date_to += timedelta(days=1)
+        if is_datetime:
+            date_to = datetime.combine(date_to, datetime.min.time())
+        search.append(column < date_to)
+    return search
+
+
 class Tariff(db.Model, Entity):
     name = db.Column(db.String(64), index=True, nullable=False)
     max_locations = db.Column(db.Integer, default=1)
@@ -228,6 +574,8 @@ class Tariff(db.Model, Entity):
     max_staff = db.Column(db.Integer, default=1)
     chat = db.Column(db.Boolean, default=False)
     api = db.Column(db.Boolean, default=False)
+    api_rate_limit = db.Column(db.Integer, default=600)
+    api_burst = db.Column(db.Integer, default=100)
     default = db.Column(db.Boolean, default=False)
     price_ils = db.Column(db.Integer, default=0)
     price_usd = db.Column(db.Integer, default=0)
@@ -335,7 +683,7 @@ class CompanyConfig(db.Model, Entity, Splitter):
     default_time_to = db.Column(db.Time, default=datetime.strptime('18:00', '%H:%M').time())
     simple_mode = db.Column(db.Boolean, default=True)
     show_quick_start = db.Column(db.Boolean, default=True)
-    tariff_id = db.Column(db.Integer, db.ForeignKey('tariff.id'))
+    tariff_id = db.Column(db.Integer, db.ForeignKey('tariff.id'), index=True)
 
     @staticmethod
     def get_parameter(name):
@@ -450,15 +798,15 @@ class User(UserMixin, db.Model, Entity, Splitter):
         return user
 
 
-class Staff(db.Model, Entity, Splitter):
+class Staff(db.Model, Entity, Splitter, PhoneIndex, NameIndex):
     table_link = 'staff_table'
     sort = 'name'
-    search = [('name', 'Name', str),
-              ('phone', 'Phone', str)]
+    search = [('name', 'Name', FullText),
+              ('phone', 'Phone', FullText)]
     name = db.Column(db.String(64), index=True, nullable=False)
     phone = db.Column(db.String(16), index=True, nullable=False)
     birthday = db.Column(db.Date)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     appointments = db.relationship('Appointment', backref='staff')
     schedules = db.relationship('Schedule', secondary=staff_schedules,
                                 backref=db.backref('staff', lazy=True))
@@ -486,11 +834,7 @@ class Staff(db.Model, Entity, Splitter):
         param = dict(staff_id=self.id, date=date)
         holiday = Holiday.find_object(param)
         if holiday:
-            hour_from = hour_to = datetime.strptime('00.00', '%H.%M')
-            if holiday.working_day:
-                hour_from = datetime.combine(date, holiday.hour_from)
-                hour_to = datetime.combine(date, holiday.hour_to)
-            return {'hour_from': hour_from, 'hour_to': hour_to}
+            return holiday.get_work_time()
         else:
             return []
 
@@ -505,12 +849,13 @@ class Tag(db.Model, Entity, Splitter):
         return self.name
 
 
-class Client(db.Model, Entity, Splitter):
+class Client(db.Model, Entity, Splitter, PhoneIndex, NameIndex):
     table_link = 'clients_table'
     sort = 'name'
+    remote_choices = True
     search = [('tags', 'Tags', Tag),
-              ('name', 'Name', str),
-              ('phone', 'Phone', str)]
+              ('name', 'Name', FullText),
+              ('phone', 'Phone', FullText)]
     name = db.Column(db.String(64), index=True, nullable=False)
     phone = db.Column(db.String(16), index=True, nullable=False)
     birthday = db.Column(db.Date)
@@ -519,7 +864,6 @@ class Client(db.Model, Entity, Splitter):
     notices = db.relationship('Notice', backref='client', cascade='all, delete')
     appointments = db.relationship('Appointment', backref='client')
     tags = db.relationship('Tag', secondary=clients_tags,
-                           lazy='selectin',
                            backref=db.backref('clients', lazy=True))
 
     def __repr__(self):
@@ -541,7 +885,7 @@ class ClientFile(db.Model, Entity, Splitter):
     sort = 'name'
     search = [('name', 'Title', str)]
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'),
-                          nullable=False)
+                          nullable=False, index=True)
     name = db.Column(db.String(64))
     path = db.Column(db.String(128))
     hash = db.Column(db.String(64))
@@ -565,7 +909,6 @@ class Location(db.Model, Entity, Splitter):
     item_flows = db.relationship('ItemFlow', backref='location',
                                  cascade='all, delete')
     services = db.relationship('Service', secondary=services_locations,
-                               lazy='selectin',
                                backref=db.backref('locations', lazy=True))
     schedules = db.relationship('Schedule', secondary=locations_schedules,
                                 backref=db.backref('locations', lazy=True))
@@ -593,7 +936,7 @@ class Location(db.Model, Entity, Splitter):
         return service in self.services
 
 
-class Service(db.Model, Entity, Splitter):
+class Service(db.Model, Entity, Splitter, NameIndex):
     table_link = 'services_table'
     sort = 'name'
     search = [('locations', 'Location', Location),
@@ -602,10 +945,8 @@ class Service(db.Model, Entity, Splitter):
     duration = db.Column(db.Integer)
     price = db.Column(db.Float)
     repeat = db.Column(db.Integer)
-    appointments = db.relationship('Appointment',
-                                   secondary=appointments_services,
-                                   lazy='selectin',
-                                   backref=db.backref('services', lazy=True))
+    appointment_services = db.relationship('AppointmentService',
+                                           back_populates='service')
 
     def __repr__(self):
         active = ''
@@ -627,16 +968,31 @@ class Appointment(db.Model, Entity, Splitter):
               ('payment_id', 'Payment', type(None)),
               ('date_time', 'Date', Period)]
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'),
-                            nullable=False)
+                            nullable=False, index=True)
     date_time = db.Column(db.DateTime, nullable=False)
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'))
-    staff_id = db.Column(db.Integer, db.ForeignKey('staff.id'))
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), index=True)
+    staff_id = db.Column(db.Integer, db.ForeignKey('staff.id'), index=True)
     no_check_duration = db.Column(db.Boolean, default=False)
     allow_booking_this_time = db.Column(db.Boolean, default=False)
     info = db.Column(db.Text)
     result = db.Column(db.Text)
-    payment_id = db.Column(db.Integer, db.ForeignKey('cash_flow.id'))
+    payment_id = db.Column(db.Integer, db.ForeignKey('cash_flow.id'), index=True)
     cancel = db.Column(db.Boolean, default=False)
+    total_duration = db.Column(db.Integer, default=0)
+    total_cost = db.Column(db.Float, default=0)
+    time_end = db.Column(db.DateTime, index=True)
+    date_repeat = db.Column(db.Date)
+    series_id = db.Column(db.Integer, index=True)
+    __table_args__ = (db.Index('ix_appointment_cid_staff_id_date_time',
+                               'cid', 'staff_id', 'date_time'),)
+    appointment_services = db.relationship('AppointmentService',
+                                           back_populates='appointment',
+                                           cascade='all, delete-orphan')
+    services = association_proxy('appointment_services', 'service',
+                                 creator=lambda service: AppointmentService(
+                                     service=service,
+                                     price=service.price,
+                                     duration=service.duration))
 
     def __repr__(self):
         cancel = ''
@@ -647,37 +1003,38 @@ class Appointment(db.Model, Entity, Splitter):
 
     @property
     def cost(self):
-        cost = 0
-        for service in self.services:
-            cost += service.price
-        return cost
+        return self.total_cost or 0
 
     @property
     def duration(self):
-        duration = 0
-        for service in self.services:
-            duration += service.duration
-        return timedelta(minutes=duration)
-
-    @property
-    def date_repeat(self):
-        repeat_list = [s.repeat for s in self.services if s.repeat > 0]
+        return timedelta(minutes=self.total_duration or 0)
+
+    def update_totals(self):
+        items = list(self.appointment_services)
+        self.total_duration = sum(i.duration or 0 for i in items)
+        self.total_cost = sum(i.price or 0 for i in items)
+        self.time_end = self.date_repeat = None
+        if self.date_time:
+            self.time_end = self.date_time + self.duration
+            period = self.get_repeat_period()
+            if period:
+                self.date_repeat = (self.date_time + timedelta(days=period)).date()
+
+    def get_repeat_period(self):
+        repeat_list = [i.service.repeat for i in self.appointment_services
+                       if i.service.repeat and i.service.repeat > 0]
         if repeat_list:
-            period = min(repeat_list)
-            return (self.date_time + timedelta(days=period)).date()
-        return None
-
-    @property
-    def time_end(self):
-        return self.date_time + self.duration
+            return min(repeat_list)
 
     def add_service(self, service):
         if not self.is_service(service):
             self.services.append(service)
+            self.update_totals()
 
     def remove_service(self, service):
         if self.is_service(service):
             self.services.remove(service)
+            self.update_totals()
 
     def is_service(self, service):
         return service in self.services
@@ -696,7 +1053,8 @@ class Appointment(db.Model, Entity, Splitter):
                            isouter=True)
         if data_search:
             items = items.filter(*data_search)
-        items = items.with_entities(Location.name, Staff.name,
+        items = items.with_entities(cls.location_id, cls.staff_id,
+                                    Location.name, Staff.name,
                                     func.count(cls.id),
                                     func.coalesce(func.sum(CashFlow.cost), 0)
                                     ).group_by(cls.location_id, cls.staff_id)
@@ -706,8 +1064,16 @@ class Appointment(db.Model, Entity, Splitter):
             items = items.order_by(Location.name.asc(), Staff.name.asc())
         else:
             items = items.order_by(getattr(cls, cls.sort).desc())
+        revenue = AppointmentService.get_revenue(['location_id', 'staff_id'],
+                                                 data_filter, data_search)
         headers = ['location', 'staff', 'count', 'sum']
-        return [dict(list(zip(headers, item))) for item in items.all()]
+        result = []
+        for location_id, staff_id, *item in items.all():
+            row = dict(list(zip(headers, item)))
+            row['revenue'] = revenue.get((location_id, staff_id),
+                                         {'sum': 0})['sum']
+            result.append(row)
+        return result
 
     def delete_object(self, *args, **kwargs):
         payment = self.payment
@@ -716,6 +1082,126 @@ class Appointment(db.Model, Entity, Splitter):
             payment.delete_object(silent_mode=True)
 
 
+class AppointmentService(db.Model):
+    __tablename__ = 'appointments_services'
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'),
+                               primary_key=True)
+    service_id = db.Column(db.Integer, db.ForeignKey('service.id'),
+                           primary_key=True, index=True)
+    price = db.Column(db.Float)
+    duration = db.Column(db.Integer)
+    appointment = db.relationship('Appointment',
+                                  back_populates='appointment_services')
+    service = db.relationship('Service', back_populates='appointment_services')
+
+    def __repr__(self):
+        return '<AppointmentService {} {}>'.format(self.appointment_id,
+                                                   self.service_id)
+
+    @classmethod
+    def get_revenue(cls, group_by, data_filter=None, data_search=None):
+        # group_by is a column name, or a list of names for tuple keys
+        names = [group_by] if isinstance(group_by, str) else list(group_by)
+        columns = [getattr(Appointment, name) for name in names]
+        param = {'cid': current_user.cid, 'no_active': False, 'cancel': False}
+        if data_filter:
+            param = {**param, **data_filter}
+        items = Appointment.query.filter_by(**param)
+        items = items.join(cls, cls.appointment_id == Appointment.id)
+        if data_search:
+            items = items.filter(*data_search)
+        items = items.with_entities(*columns,
+                                    func.count(distinct(cls.appointment_id)),
+                                    func.coalesce(func.sum(cls.price), 0),
+                                    func.coalesce(func.sum(cls.duration), 0)
+                                    ).group_by(*columns)
+        result = {}
+        for row in items:
+            key = row[0] if isinstance(group_by, str) else tuple(row[:len(names)])
+            count, cost, duration = row[len(names):]
+            result[key] = {'count': count, 'sum': cost, 'duration': duration}
+        return result
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def update_appointment_totals(session, flush_context, instances):
+    appointments = set()
+    for obj in set(session.new) | set(session.dirty):
+        if isinstance(obj, Appointment):
+            state = inspect(obj)
+            if (obj in session.new or
+                    state.attrs.appointment_services.history.has_changes() or
+                    state.attrs.date_time.history.has_changes()):
+                appointments.add(obj)
+    for appointment in appointments:
+        appointment.update_totals()
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def update_phone_index(session, flush_context, instances):
+    for obj in set(session.new) | set(session.dirty):
+        if isinstance(obj, PhoneIndex):
+            if (obj in session.new or
+                    inspect(obj).attrs.phone.history.has_changes()):
+                obj.update_phone_index()
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def update_name_index(session, flush_context, instances):
+    for obj in set(session.new) | set(session.dirty):
+        if isinstance(obj, NameIndex):
+            if (obj in session.new or
+                    inspect(obj).attrs.name.history.has_changes()):
+                obj.update_name_index()
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def add_tombstones(session, flush_context, instances):
+    # Deleted rows of the synced tables are reported by /api/changes/
+    for obj in session.deleted:
+        if type(obj) in SYNC_MODELS.values():
+            session.add(Tombstone(cid=obj.cid, table_name=obj.__tablename__,
+                                  object_id=obj.id))
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def collect_choices_changes(session, flush_context):
+    keys = set()
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        if not isinstance(obj, Entity) or not hasattr(obj, '__tablename__'):
+            continue
+        if obj in session.dirty:
+            attrs = inspect(obj).attrs
+            if not any(attrs[attr].history.has_changes()
+                       for attr in ('name', 'no_active', 'cid')
+                       if attr in attrs):
+                continue
+        keys.add(('choices', getattr(obj, 'cid', None), obj.__tablename__))
+        keys.add(('choices', None, obj.__tablename__))
+    if keys:
+        session.info.setdefault('choices_changes', set()).update(keys)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_choices(session):
+    bump_versions(session.info.pop('choices_changes', set()))
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_choices_changes(session):
+    session.info.pop('choices_changes', None)
+
+
+class Tombstone(db.Model, Splitter):
+    __table_args__ = (db.Index('ix_tombstone_cid_timestamp_id',
+                               'cid', 'timestamp', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime(), default=datetime.utcnow,
+                          nullable=False)
+
+
 class PaymentMethod:
     items = {100: _l('Cash'),
              200: _l('Card'),
@@ -732,6 +1218,35 @@ class PaymentMethod:
         return items
 
 
+class Recurrence:
+    weekly = 1
+    days = 2
+    service = 3
+    max_count = 52
+    items = {weekly: _l('Every N weeks'),
+             days: _l('Every N days'),
+             service: _l('By service repeat')}
+
+    @classmethod
+    def get_items(cls, tuple_mode=False):
+        if tuple_mode:
+            items = [(key, value) for (key, value) in cls.items.items()]
+            items.insert(0, (0, _l('No repeat')))
+        else:
+            items = [i for i in cls.items]
+        return items
+
+    @classmethod
+    def get_dates(cls, rule, date_time, count, interval=1, period=None):
+        # start of every occurrence after the first one
+        step = {cls.weekly: 7 * (interval or 0),
+                cls.days: interval or 0,
+                cls.service: period or 0}.get(rule, 0)
+        if step < 1 or not count or count < 1:
+            return []
+        return [date_time + timedelta(days=step * i) for i in range(1, count + 1)]
+
+
 class Week:
     days = [_l('Monday'), _l('Tuesday'), _l('Wednesday'), _l('Thursday'),
             _l('Friday'), _l('Saturday'), _l('Sunday')]
@@ -792,7 +1307,7 @@ class ScheduleDay(db.Model, Entity, Splitter):
     sort = 'day_number'
     search = [('day_number', 'Weekday', Week)]
     schedule_id = db.Column(db.Integer,
-                            db.ForeignKey('schedule.id'), nullable=False)
+                            db.ForeignKey('schedule.id'), nullable=False, index=True)
     day_number = db.Column(db.Integer)
     hour_from = db.Column(db.Time)
     hour_to = db.Column(db.Time)
@@ -840,8 +1355,8 @@ class ItemFlow(db.Model, Entity, Splitter):
               ('item_id', 'Item', Item),
               ('date', 'Date', type(datetime.now()))]
     date = db.Column(db.Date, nullable=False)
-    location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
-    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), index=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer)
     cost = db.Column(db.Float)
 
@@ -852,7 +1367,7 @@ class Storage(db.Model, Entity, Splitter):
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'),
                             primary_key=True)
     item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False,
-                        primary_key=True)
+                        primary_key=True, index=True)
     quantity = db.Column(db.Integer)
 
 
@@ -863,7 +1378,7 @@ class CashFlow(db.Model, Entity, Splitter):
     search = [('location_id', 'Location', Location),
               ('date', 'Date', Period)]
     date = db.Column(db.Date, nullable=False)
-    location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), index=True)
     description = db.Column(db.String(255))
     cost = db.Column(db.Float)
     payment_method_id = db.Column(db.Integer)
@@ -911,7 +1426,7 @@ class Notice(db.Model, Entity, Splitter):
               ('processed', 'Processed', bool),
               ('date', 'Date', type(datetime.now()))]
     date = db.Column(db.Date, nullable=False)
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'))
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), index=True)
     description = db.Column(db.String(255))
     processed = db.Column(db.Boolean, default=False)
 
@@ -930,11 +1445,18 @@ class Holiday(db.Model, Entity, Splitter):
     search = [('staff_id', 'Worker', Staff),
               ('date', 'Date', type(datetime.now()))]
     date = db.Column(db.Date, nullable=False)
-    staff_id = db.Column(db.Integer, db.ForeignKey('staff.id'))
+    staff_id = db.Column(db.Integer, db.ForeignKey('staff.id'), index=True)
     working_day = db.Column(db.Boolean, default=False)
     hour_from = db.Column(db.Time)
     hour_to = db.Column(db.Time)
 
+    def get_work_time(self):
+        hour_from = hour_to = datetime.strptime('00.00', '%H.%M')
+        if self.working_day:
+            hour_from = datetime.combine(self.date, self.hour_from)
+            hour_to = datetime.combine(self.date, self.hour_to)
+        return {'hour_from': hour_from, 'hour_to': hour_to}
+
 
 class Assistant:
     search = [('location_id', 'Location', Location),
@@ -952,9 +1474,47 @@ class NationalHoliday(db.Model, Entity):
     def get_month_holidays(cls, year, month):
         result = {'items': {}, 'dates': set()}
         if isinstance(month, int) and (1 <= month <= 12):
-            data_search = [extract('year', cls.date) == year,
-                           extract('month', cls.date) == month]
+            date_from = datetime(year, month, 1).date()
+            date_to = (date_from + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+            data_search = get_date_range(cls.date, date_from, date_to)
             items = cls.get_items(data_search=data_search, overall=True)
             result['items'] = {i.date: i.name for i in items}
             result['dates'] = set([i.date for i in items])
         return result
+
+
+def get_tenant_index_columns(model):
+    # get_query always filters by cid and no_active and orders by sort
+    table = model.__table__
+    columns = [c for c in ('cid', 'no_active', model.sort) if c in table.c]
+    return list(dict.fromkeys(columns))
+
+
+def add_tenant_indexes():
+    for model in Entity.__subclasses__():
+        if issubclass(model, Splitter) and hasattr(model, '__table__'):
+            columns = get_tenant_index_columns(model)
+            db.Index('ix_{}_{}'.format(model.__tablename__, '_'.join(columns)),
+                     *[model.__table__.c[c] for c in columns])
+
+
+def add_typeahead_indexes():
+    for model in TYPEAHEAD_MODELS.values():
+        table = model.__table__
+        db.Index('ix_{}_cid_name_fold'.format(model.__tablename__),
+                 table.c.cid, table.c.name_fold)
+
+
+def add_sync_indexes():
+    for model in SYNC_MODELS.values():
+        table = model.__table__
+        db.Index('ix_{}_cid_timestamp_update_id'.format(model.__tablename__),
+                 table.c.cid, table.c.timestamp_update, table.c.id)
+
+
+TYPEAHEAD_MODELS = {'client': Client, 'staff': Staff, 'service': Service}
+SYNC_MODELS = {'client': Client, 'staff': Staff, 'service': Service,
+               'appointment': Appointment}
+add_tenant_indexes()
+add_typeahead_indexes()
+add_sync_indexes()
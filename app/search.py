@@ -0,0 +1,173 @@
+import time
+
+from sqlalchemy import event, inspect, text, bindparam, Integer, or_
+
+from app import db
+from .models import Entity, FullText, PhoneIndex
+
+# Substring search for fields declared as FullText in Entity.search.
+# SQLite keeps an FTS5 table with the trigram tokenizer per model
+# (search_<table>, rowid = object id), PostgreSQL uses pg_trgm GIN indexes
+# that serve ILIKE directly, other databases fall back to a plain ILIKE.
+MIN_TRIGRAM_LENGTH = 3
+READY_CHECK_INTERVAL = 60
+
+
+def get_fulltext_fields(model):
+    return [attr for attr, _, search_type in model.search
+            if issubclass(search_type, FullText)]
+
+
+def get_fulltext_models():
+    return [model for model in Entity.__subclasses__()
+            if hasattr(model, '__table__') and get_fulltext_fields(model)]
+
+
+class SearchBackend:
+
+    def setup(self, connection):
+        pass
+
+    def rebuild(self, connection, model):
+        pass
+
+    def is_ready(self, connection, model, throttle=True):
+        return True
+
+    def get_condition(self, model, attr, term):
+        return getattr(model, attr).ilike(f'%{term}%')
+
+    def update(self, connection, model, obj):
+        pass
+
+    def remove(self, connection, model, obj):
+        pass
+
+
+class SQLiteSearchBackend(SearchBackend):
+
+    def __init__(self):
+        self.ready = set()
+        self.checked = {}
+
+    @staticmethod
+    def get_table(model):
+        return 'search_' + model.__tablename__
+
+    def setup(self, connection):
+        for model in get_fulltext_models():
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, "
+                "tokenize='trigram')".format(self.get_table(model),
+                                            ', '.join(get_fulltext_fields(model)))))
+            self.ready.add(self.get_table(model))
+
+    def rebuild(self, connection, model):
+        fields = get_fulltext_fields(model)
+        table = self.get_table(model)
+        connection.execute(text('DELETE FROM {}'.format(table)))
+        connection.execute(text('INSERT INTO {} (rowid, {}) SELECT id, {} FROM {}'.format(
+            table, ', '.join(fields), ', '.join(fields), model.__tablename__)))
+
+    def is_ready(self, connection, model, throttle=True):
+        # Searches look for a missing table at most once a minute, writes
+        # always look so that rows added after a rebuild are not lost
+        table = self.get_table(model)
+        if table in self.ready:
+            return True
+        checked = self.checked.get(table)
+        if (throttle and checked is not None and
+                time.monotonic() - checked < READY_CHECK_INTERVAL):
+            return False
+        self.checked[table] = time.monotonic()
+        if inspect(connection).has_table(table):
+            self.ready.add(table)
+        return table in self.ready
+
+    def get_condition(self, model, attr, term):
+        if (len(term) < MIN_TRIGRAM_LENGTH or
+                not self.is_ready(db.session.connection(), model)):
+            return super(SQLiteSearchBackend, self).get_condition(model, attr,
+                                                                  term)
+        query = '"{}"'.format(term.replace('"', '""'))
+        rows = text('SELECT rowid FROM {} WHERE {} MATCH :query'.format(
+            self.get_table(model), attr)).bindparams(
+            bindparam('query', query, unique=True))
+        return model.id.in_(rows.columns(rowid=Integer))
+
+    def update(self, connection, model, obj):
+        if not self.is_ready(connection, model, throttle=False):
+            return
+        fields = get_fulltext_fields(model)
+        connection.execute(text(
+            'INSERT OR REPLACE INTO {} (rowid, {}) VALUES (:id, {})'.format(
+                self.get_table(model), ', '.join(fields),
+                ', '.join(':' + f for f in fields))),
+            {'id': obj.id, **{f: getattr(obj, f) for f in fields}})
+
+    def remove(self, connection, model, obj):
+        if not self.is_ready(connection, model, throttle=False):
+            return
+        connection.execute(text('DELETE FROM {} WHERE rowid = :id'.format(
+            self.get_table(model))), {'id': obj.id})
+
+
+class PostgresSearchBackend(SearchBackend):
+
+    def setup(self, connection):
+        connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        for model in get_fulltext_models():
+            for field in get_fulltext_fields(model):
+                connection.execute(text(
+                    'CREATE INDEX IF NOT EXISTS ix_{0}_{1}_trgm ON "{0}" '
+                    'USING gin ({1} gin_trgm_ops)'.format(model.__tablename__,
+                                                          field)))
+
+
+backends = {'sqlite': SQLiteSearchBackend(),
+            'postgresql': PostgresSearchBackend()}
+
+
+def get_backend(connection=None):
+    bind = connection if connection is not None else db.engine
+    return backends.get(bind.dialect.name, SearchBackend())
+
+
+def get_search_condition(model, attr, term):
+    if attr in get_fulltext_fields(model):
+        condition = get_backend().get_condition(model, attr, term)
+    else:
+        condition = SearchBackend().get_condition(model, attr, term)
+    if attr == 'phone' and issubclass(model, PhoneIndex):
+        # The normalized ranges also find numbers stored in another format,
+        # the substring match keeps the digits found inside the number
+        phone_condition = model.get_phone_condition(term)
+        if phone_condition is not None:
+            return or_(phone_condition, condition)
+    return condition
+
+
+def update_search_index(mapper, connection, target):
+    model = mapper.class_
+    if not any(inspect(target).attrs[f].history.has_changes()
+               for f in get_fulltext_fields(model)):
+        return
+    get_backend(connection).update(connection, model, target)
+
+
+def insert_search_index(mapper, connection, target):
+    get_backend(connection).update(connection, mapper.class_, target)
+
+
+def remove_search_index(mapper, connection, target):
+    get_backend(connection).remove(connection, mapper.class_, target)
+
+
+def register_search_events():
+    for model in get_fulltext_models():
+        event.listen(model, 'after_insert', insert_search_index)
+        event.listen(model, 'after_update', update_search_index)
+        event.listen(model, 'after_delete', remove_search_index)
+
+
+register_search_events()
@@ -0,0 +1,97 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+from flask_login import current_user
+from sqlalchemy import and_, or_
+
+from .models import SYNC_MODELS, Tombstone
+
+# Changes of the synced tables as one stream ordered by (timestamp, table, id),
+# the cursor is the key of the last change returned. Soft-deleted rows
+# (no_active) and tombstones of deleted rows are reported as deletions.
+# Timestamps are taken at flush, so a transaction may commit a change older
+# than a cursor already handed out; changes younger than SYNC_DELAY are held
+# back until such transactions are done. A transaction that commits later
+# than SYNC_DELAY after its flush can still be missed by incremental syncs.
+TOMBSTONE = 'tombstone'
+SYNC_DELAY = timedelta(seconds=30)
+
+
+def encode_cursor(key):
+    timestamp, table, id = key
+    data = json.dumps([timestamp.isoformat(), table, id]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, table, id = json.loads(data)
+        return datetime.fromisoformat(timestamp), str(table), int(id)
+    except (ValueError, TypeError):
+        return None
+
+
+def get_after_condition(timestamp_column, id_column, table, key):
+    # (timestamp, table, id) > key for the rows of one table
+    if key is None:
+        return []
+    timestamp, key_table, id = key
+    if table > key_table:
+        return [timestamp_column >= timestamp]
+    if table < key_table:
+        return [timestamp_column > timestamp]
+    return [or_(timestamp_column > timestamp,
+                and_(timestamp_column == timestamp, id_column > id))]
+
+
+def get_table_changes(table, key, limit, until):
+    model = SYNC_MODELS[table]
+    columns = model.get_columns()
+    search = get_after_condition(model.timestamp_update, model.id, table, key)
+    search.append(model.timestamp_update <= until)
+    items = model.query.filter_by(cid=current_user.cid).filter(*search).order_by(
+        model.timestamp_update.asc(), model.id.asc()).with_entities(
+        *columns).limit(limit)
+    changes = []
+    for row in items:
+        row = dict(zip([c.name for c in columns], row))
+        deleted = bool(row['no_active'])
+        changes.append(((row['timestamp_update'], table, row['id']),
+                        {'table': table, 'id': row['id'], 'deleted': deleted,
+                         'timestamp': row['timestamp_update'],
+                         'data': None if deleted else row}))
+    return changes
+
+
+def get_tombstone_changes(tables, key, limit, until):
+    search = get_after_condition(Tombstone.timestamp, Tombstone.id, TOMBSTONE,
+                                 key)
+    search.append(Tombstone.table_name.in_(tables))
+    search.append(Tombstone.timestamp <= until)
+    items = Tombstone.query.filter_by(cid=current_user.cid).filter(
+        *search).order_by(Tombstone.timestamp.asc(), Tombstone.id.asc()).with_entities(
+        Tombstone.id, Tombstone.table_name, Tombstone.object_id,
+        Tombstone.timestamp).limit(limit)
+    return [((timestamp, TOMBSTONE, id),
+             {'table': table, 'id': object_id, 'deleted': True,
+              'timestamp': timestamp, 'data': None})
+            for id, table, object_id, timestamp in items]
+
+
+def get_changes(key=None, limit=100, tables=None):
+    # Every source is read up to limit + 1 rows past the cursor, merging them
+    # gives the next limit changes of the stream and whether more follow
+    tables = list(tables or SYNC_MODELS)
+    until = datetime.utcnow() - SYNC_DELAY
+    changes = []
+    for table in tables:
+        changes.extend(get_table_changes(table, key, limit + 1, until))
+    changes.extend(get_tombstone_changes(tables, key, limit + 1, until))
+    changes.sort(key=lambda x: x[0])
+    more = len(changes) > limit
+    changes = changes[:limit]
+    if changes:
+        key = changes[-1][0]
+    return [change for _, change in changes], key, more
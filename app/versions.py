@@ -0,0 +1,36 @@
+import uuid
+
+from app import cache
+
+VERSION_TIMEOUT = 7200
+
+
+# Cached values embed version tokens of their scopes in the key;
+# bumping a token makes every key built from the old one unreachable.
+# Tokens outlive the values built from them (VERSION_TIMEOUT), an expired
+# token is regenerated, which works as a bump
+def make_key(*args):
+    return ':'.join(str(a) for a in args)
+
+
+def get_versions(keys):
+    keys = list(keys)
+    if not keys:
+        return {}
+    version_keys = [make_key('version', *key) for key in keys]
+    values = cache.get_many(*version_keys)
+    missing = {}
+    for i, value in enumerate(values):
+        if value is None:
+            value = uuid.uuid4().hex
+            missing[version_keys[i]] = value
+        values[i] = value
+    if missing:
+        cache.set_many(missing, timeout=VERSION_TIMEOUT)
+    return dict(zip(keys, values))
+
+
+def bump_versions(keys):
+    if keys:
+        cache.set_many({make_key('version', *key): uuid.uuid4().hex
+                        for key in keys}, timeout=VERSION_TIMEOUT)
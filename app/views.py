@@ -13,7 +13,7 @@ import pandas as pd
 import qrcode
 from dateutil.relativedelta import relativedelta
 from pandas import ExcelWriter
-from sqlalchemy.orm import RelationshipProperty
+from sqlalchemy.orm import RelationshipProperty, selectinload
 
 import app
 import hashlib
@@ -28,6 +28,7 @@ from .bot import send_bot_message
 from app.forms import *
 from app.functions import *
 from app.models import *
+from app.search import get_search_condition
 
 
 doc_version = minidom.parse('version.xml')
@@ -180,47 +181,20 @@ def delete(class_name, object_id):
 def set_filter(class_object):
     search_list = []
     for search_attr, search_name, search_object in class_object.search:
-        search_list.append(search_attr)
-        if issubclass(search_object, Entity) or issubclass(search_object, Week):
-            choices = search_object.get_items(True)
-            setattr(SearchForm, search_attr, SelectField(_l(search_name),
-                                                         choices=[*choices],
-                                                         coerce=int))
-        elif issubclass(search_object, bool) or issubclass(search_object,
-                                                           type(None)):
-            choices = [('', _l('-Select-')),
-                       ('False', _l('False')),
-                       ('True', _l('True'))]
-            setattr(SearchForm, search_attr, SelectField(_l(search_name),
-                                                         choices=[*choices],
-                                                         coerce=str))
-        elif issubclass(search_object, type(datetime.now())):
-            setattr(SearchForm, search_attr,
-                    DateField(_l(search_name),
-                              validators=[validate_date_global]))
-        elif issubclass(search_object, Period):
-            search_attr_from = search_attr + '_from'
-            search_attr_to = search_attr + '_to'
-            setattr(SearchForm, search_attr_from,
-                    DateField(_l('Date from'),
-                              validators=[validate_date_global]))
-            setattr(SearchForm, search_attr_to,
-                    DateField(_l('Date to'),
-                              validators=[validate_date_global]))
-            search_list.remove(search_attr)
-            search_list.append(search_attr_from)
-            search_list.append(search_attr_to)
+        if issubclass(search_object, Period):
+            search_list.extend((search_attr + '_from', search_attr + '_to'))
         else:
-            setattr(SearchForm, search_attr, StringField(_l(search_name)))
-    rest_args = list(set(request.args.keys()).difference(set(search_list)))
-    rest_args_dict = {}
-    ignore_list = ['page']
-    for ra in rest_args:
-        if ra not in ignore_list:
-            setattr(SearchForm, ra, HiddenField(ra))
-            rest_args_dict[ra] = request.args.get(ra, None)
-    setattr(SearchForm, 'filter', HiddenField('filter'))
-    return SearchForm(request.form, meta={'csrf': False}, **rest_args_dict)
+            search_list.append(search_attr)
+    ignore_list = ['page', 'cursor', 'filter']
+    hidden_args = {ra: request.args.get(ra, None) for ra in request.args.keys()
+                   if ra not in search_list and ra not in ignore_list}
+    form = get_search_form_class(class_object)(request.form, meta={'csrf': False},
+                                               hidden_args=hidden_args)
+    for search_attr, search_name, search_object in class_object.search:
+        if issubclass(search_object, Entity) or issubclass(search_object, Week):
+            if not isinstance(form[search_attr], RemoteSelectField):
+                form[search_attr].choices = search_object.get_items(True)
+    return form
 
 
 def get_filter_parameters(form, class_object):
@@ -264,8 +238,8 @@ def get_filter_parameters(form, class_object):
                     check_filter = False
                     flash(_l('Invalid date'))
             else:
-                search_param.append(getattr(class_object, search_attr
-                                            ).ilike(f'%{str(request_arg)}%'))
+                search_param.append(get_search_condition(class_object, search_attr,
+                                                         str(request_arg)))
                 form[search_attr].data = request_arg
         if issubclass(search_object, Period):
             search_attr_from = search_attr + '_from'
@@ -274,9 +248,9 @@ def get_filter_parameters(form, class_object):
             request_arg_to = request.args.get(search_attr_to, None, type=str)
             if request_arg_from and not request_arg_from == '0':
                 try:
-                    search_param.append(func.date(
-                        getattr(class_object, search_attr)) >=
-                                        datetime.strptime(request_arg_from, '%Y-%m-%d').date())
+                    search_param.extend(get_date_range(
+                        getattr(class_object, search_attr),
+                        date_from=datetime.strptime(request_arg_from, '%Y-%m-%d')))
                     form[search_attr_from].data = datetime.strptime(
                         request_arg_from, '%Y-%m-%d')
                     check_filter = True
@@ -284,30 +258,15 @@ def get_filter_parameters(form, class_object):
                     flash(_l('Invalid date'))
             if request_arg_to and not request_arg_to == '0':
                 try:
-                    search_param.append(func.date(
-                        getattr(class_object, search_attr)) <
-                                        (datetime.strptime(request_arg_to, '%Y-%m-%d') +
-                                         timedelta(days=1)).date())
+                    search_param.extend(get_date_range(
+                        getattr(class_object, search_attr),
+                        date_to=datetime.strptime(request_arg_to, '%Y-%m-%d')))
                     form[search_attr_to].data = datetime.strptime(
                         request_arg_to, '%Y-%m-%d').date()
                     check_filter = True
                 except ValueError:
                     flash(_l('Invalid date'))
-            delattr(SearchForm, search_attr_from)
-            delattr(SearchForm, search_attr_to)
-        if hasattr(SearchForm, search_attr):
-            delattr(SearchForm, search_attr)
-    for ra in list(request.args.keys()):
-        if hasattr(SearchForm, ra):
-            delattr(SearchForm, ra)
     form.filter.data = check_filter
-    if hasattr(SearchForm, 'filter'):
-        delattr(SearchForm, 'filter')
-    choice_mode = request.args.get('choice_mode', None)
-    if choice_mode:
-        form.choice_mode.data = choice_mode
-    if hasattr(SearchForm, 'choice_mode'):
-        delattr(SearchForm, 'choice_mode')
     return filter_param, search_param
 
 
@@ -1167,7 +1126,8 @@ def services_table():
         template = 'service_table.html'
     form = set_filter(Service)
     param = get_filter_parameters(form, Service)
-    data = Service.get_pagination(page, *param)
+    data = Service.get_pagination(page, *param,
+                                  options=[selectinload(Service.locations)])
     return render_template(template,
                            title=_('Services'),
                            items=data.items,
@@ -1399,10 +1359,13 @@ def appointment_assistant():
 @login_required
 def appointments_table():
     clear_session()
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     form = set_filter(Appointment)
     param = get_filter_parameters(form, Appointment)
-    data = Appointment.get_pagination(page, *param)
+    data = Appointment.get_keyset_pagination(
+        cursor, *param, options=[selectinload(Appointment.location),
+                                 selectinload(Appointment.staff),
+                                 selectinload(Appointment.client)])
     return render_template('timetable_card.html',
                            title=_('Timetable'),
                            items=data.items,
@@ -1433,13 +1396,10 @@ def appointment_create():
         form.time.choices = (selected_time, selected_time)
     form.location.choices = Location.get_items(True)
     form.staff.choices = Staff.get_items(True)
-    form.client.choices = Client.get_items(True)
     selected_services = []
     if selected_services_id:
         form.duration.data = get_duration(selected_services_id)
-        for service_id in selected_services_id:
-            service = Service.get_object(service_id)
-            selected_services.append(service)
+        selected_services = Service.get_objects(selected_services_id)
         form.services.data = ','.join(list(str(s) for s in selected_services_id))
     if form.validate_on_submit():
         time = datetime.strptime(form.time.data, '%H:%M').time()
@@ -1459,6 +1419,10 @@ def appointment_create():
         db.session.flush()
         for service in selected_services:
             appointment.add_service(service)
+        if form.recurrence.data and form.repeat_count.data:
+            create_series(appointment, form.recurrence.data,
+                          form.repeat_count.data, form.repeat_interval.data,
+                          not form.allow_booking_this_time.data)
         db.session.commit()
         clear_session()
         return redirect(url_for('appointments_table'))
@@ -1477,6 +1441,7 @@ def appointment_create():
     return render_template('appointment_form.html',
                            title=_('Appointment (create)'),
                            form=form,
+                           series_mode=True,
                            items=selected_services,
                            url_back=url_back,
                            url_select_service=url_select_service,
@@ -1502,10 +1467,7 @@ def appointment_edit(id):
     url_select_client = url_for('clients_table',
                                 choice_mode=1,
                                 url_back=request.path)
-    selected_services = []
-    for service_id in selected_services_id:
-        service = Service.get_object(service_id)
-        selected_services.append(service)
+    selected_services = Service.get_objects(selected_services_id)
     selected_services.sort(key=lambda x: x.name)
     selected_location_id = session.get('location')
     selected_staff_id = session.get('staff')
@@ -1516,7 +1478,6 @@ def appointment_edit(id):
     form.duration.data = get_duration(selected_services_id)
     form.location.choices = Location.get_items(True)
     form.staff.choices = Staff.get_items(True)
-    form.client.choices = Client.get_items(True)
     current_time = appointment.date_time.time().strftime('%H:%M')
     form.services.data = ','.join(list(str(s) for s in selected_services_id))
     if form.validate_on_submit():
@@ -1532,7 +1493,9 @@ def appointment_edit(id):
         appointment.no_check_duration = form.no_check_duration.data
         appointment.allow_booking_this_time = form.allow_booking_this_time.data
         appointment.info = form.info.data
-        appointment.services.clear()
+        for service in list(appointment.services):
+            if service not in selected_services:
+                appointment.remove_service(service)
         for service in selected_services:
             appointment.add_service(service)
         db.session.commit()
@@ -1681,10 +1644,10 @@ def item_edit(id):
 @app.route('/items_flow/')
 @login_required
 def items_flow_table():
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     form = set_filter(ItemFlow)
     param = get_filter_parameters(form, ItemFlow)
-    data = ItemFlow.get_pagination(page, *param)
+    data = ItemFlow.get_keyset_pagination(cursor, *param)
     return render_template('item_flow_table.html',
                            title=_('Items flow'),
                            items=data.items,
@@ -1803,7 +1766,6 @@ def notice_create():
     appointment = Appointment.get_object(appointment_id, False)
     form = NoticeForm()
     form.processed.render_kw = {'disabled': ''}
-    form.client.choices = Client.get_items(True)
     url_select_client = url_for('clients_table',
                                 choice_mode=1,
                                 url_back=request.path)
@@ -1844,7 +1806,6 @@ def notice_edit(id):
                                                     **request.args))
     notice = Notice.get_object(id)
     form = NoticeForm()
-    form.client.choices = Client.get_items(True)
     selected_client_id = session.get('client')
     url_select_client = url_for('clients_table',
                                 choice_mode=1,
@@ -1896,10 +1857,10 @@ def cash_table():
 @login_required
 @admin_required
 def cash_flow_table():
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     form = set_filter(CashFlow)
     param = get_filter_parameters(form, CashFlow)
-    data = CashFlow.get_pagination(page, *param)
+    data = CashFlow.get_keyset_pagination(cursor, *param)
     return render_template('cash_flow_table.html',
                            title=_('Cash desk'),
                            items=data.items,
@@ -2039,7 +2000,7 @@ def payment_receipt():
     if link:
         payment = CashFlow.find_object({'link': link}, overall=True)
     if payment:
-        services = payment.appointment[0].services
+        services = payment.appointment[0].appointment_services
     return render_template('receipt.html',
                            payment=payment,
                            services=services)
@@ -2062,16 +2023,8 @@ def report_statistics_view():
             filter_param['location_id'] = form.location.data
         if form.staff.data:
             filter_param['staff_id'] = form.staff.data
-        date_time_from = datetime(form.date_from.data.year,
-                                  form.date_from.data.month,
-                                  form.date_from.data.day,
-                                  0, 0, 0)
-        date_time_to = datetime(form.date_to.data.year,
-                                form.date_to.data.month,
-                                form.date_to.data.day,
-                                23, 59, 59)
-        search_param = [Appointment.date_time.between(date_time_from,
-                                                      date_time_to)]
+        search_param = get_date_range(Appointment.date_time,
+                                      form.date_from.data, form.date_to.data)
         data = Appointment.get_report_statistics(data_filter=filter_param,
                                                  data_search=search_param,
                                                  sort_mode='asc')
@@ -2173,6 +2126,20 @@ def get_services():
     return jsonify(session['services'])
 
 
+@app.route('/typeahead/<name>/')
+@login_required
+def typeahead(name):
+    class_object = TYPEAHEAD_MODELS.get(name)
+    if class_object is None:
+        abort(404)
+    data_search = []
+    location_id = request.args.get('location_id', None, type=int)
+    if class_object == Service and location_id:
+        data_search.append(Service.locations.any(id=location_id))
+    return jsonify(class_object.get_typeahead(request.args.get('q', '', type=str),
+                                              data_search=data_search))
+
+
 @app.route('/get_intervals/<location_id>/<staff_id>/<date_string>/<appointment_id>/<no_check>/')
 @login_required
 def get_intervals(location_id, staff_id, date_string, appointment_id, no_check):
@@ -2199,16 +2166,8 @@ def get_intervals(location_id, staff_id, date_string, appointment_id, no_check):
             int(location_id), date.date(),
             int(staff_id), duration)
     delta_config = CompanyConfig.get_parameter('min_time_interval')
-    for interval in intervals:
-        start = interval[0] + timedelta(minutes=4)
-        start = start - timedelta(minutes=start.minute % delta_config,
-                                  seconds=start.second,
-                                  microseconds=start.microsecond)
-        delta = timedelta(minutes=delta_config)
+    for start in get_timeslots(intervals, delta_config):
         timeslots.append(start.strftime('%H:%M'))
-        while start < interval[1]:
-            start = start + delta
-            timeslots.append(start.strftime('%H:%M'))
     if current_time and current_time not in timeslots:
         timeslots.append(current_time)
     timeslots.sort()
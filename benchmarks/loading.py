@@ -0,0 +1,119 @@
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import (create_engine, event, Column, DateTime, Float,
+                        ForeignKey, Integer, String, Table)
+from sqlalchemy.orm import Session, backref, declarative_base, relationship
+
+# Location, Service and Appointment reduced to the columns and relationships
+# that matter for loading; 'selectin' is the former mapping, 'select' the
+# current one (eager loading is requested per query where it is needed);
+# tests/test_models.py checks that the real mapping keeps these settings
+SERVICES = 50
+REQUEST_SERVICES = 5
+
+
+def get_models(lazy):
+    base = declarative_base()
+    services_locations = Table(
+        'services_locations', base.metadata,
+        Column('service_id', ForeignKey('service.id'), primary_key=True),
+        Column('location_id', ForeignKey('location.id'), primary_key=True))
+    appointments_services = Table(
+        'appointments_services', base.metadata,
+        Column('appointment_id', ForeignKey('appointment.id'), primary_key=True),
+        Column('service_id', ForeignKey('service.id'), primary_key=True))
+
+    class Location(base):
+        __tablename__ = 'location'
+        id = Column(Integer, primary_key=True)
+        name = Column(String(64))
+        services = relationship('Service', secondary=services_locations,
+                                lazy=lazy,
+                                backref=backref('locations', lazy=True))
+
+    class Service(base):
+        __tablename__ = 'service'
+        id = Column(Integer, primary_key=True)
+        name = Column(String(120))
+        duration = Column(Integer)
+        price = Column(Float)
+        appointments = relationship('Appointment',
+                                    secondary=appointments_services,
+                                    lazy=lazy,
+                                    backref=backref('services', lazy=True))
+
+    class Appointment(base):
+        __tablename__ = 'appointment'
+        id = Column(Integer, primary_key=True)
+        location_id = Column(ForeignKey('location.id'))
+        date_time = Column(DateTime)
+
+    return base, Location, Service, Appointment
+
+
+def get_session(lazy, history):
+    base, Location, Service, Appointment = get_models(lazy)
+    engine = create_engine('sqlite://')
+    base.metadata.create_all(engine)
+    session = Session(engine)
+    location = Location(id=1, name='Location')
+    services = [Service(id=i, name='Service {}'.format(i), duration=30,
+                        price=10) for i in range(1, SERVICES + 1)]
+    location.services = services
+    session.add(location)
+    start = datetime(2020, 1, 1, 9)
+    for i in range(history):
+        appointment = Appointment(location_id=1,
+                                  date_time=start + timedelta(hours=i))
+        session.add(appointment)
+        appointment.services = [services[i % SERVICES],
+                                services[(i + 1) % SERVICES]]
+    session.commit()
+    session.close()
+    return engine, Location, Service
+
+
+def run_request(engine, Location, Service):
+    # what get_duration and the appointment form do with the catalog
+    with Session(engine) as session:
+        location = session.get(Location, 1)
+        for service_id in range(1, REQUEST_SERVICES + 1):
+            session.get(Service, service_id)
+        return location.name
+
+
+def measure(lazy, history):
+    engine, Location, Service = get_session(lazy, history)
+    statements = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda *args: statements.append(1))
+    tracemalloc.start()
+    started = time.perf_counter()
+    run_request(engine, Location, Service)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return len(statements), elapsed * 1000, peak / 1024
+
+
+def run():
+    print(f'{"strategy":>10} {"history":>8} {"queries":>8} '
+          f'{"ms":>8} {"peak KiB":>9}')
+    results = {}
+    for lazy in ('selectin', 'select'):
+        for history in (0, 1000, 10000):
+            queries, ms, kib = measure(lazy, history)
+            results[(lazy, history)] = (queries, kib)
+            print(f'{lazy:>10} {history:>8} {queries:>8} {ms:>8.1f} '
+                  f'{kib:>9.0f}')
+    # per request cost must not depend on how many appointments exist
+    queries_0, kib_0 = results[('select', 0)]
+    queries_n, kib_n = results[('select', 10000)]
+    assert queries_n == queries_0, 'query count grows with history'
+    assert kib_n < kib_0 * 1.5 + 64, 'memory grows with history'
+
+
+if __name__ == '__main__':
+    run()
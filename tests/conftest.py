@@ -0,0 +1,82 @@
+import pytest
+from flask import session
+from flask_login import login_user
+from sqlalchemy import text
+
+from app import app as flask_app, db, cache
+from app.models import (Company, CompanyConfig, Location, Schedule, Staff,
+                        Tariff, User)
+from app.limiter import limiter
+from app.search import backends
+
+SESSION_COUNTRY = {'country_code': '', 'country': 'Other',
+                   'currency_code': 'USD', 'currency': '$'}
+
+
+@pytest.fixture
+def app():
+    # The engine is created on first use, so the settings of config.py
+    # are replaced before any query runs
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False,
+                            SQLALCHEMY_DATABASE_URI='sqlite://')
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        for backend in backends.values():
+            backend.__init__()
+        limiter.__init__()
+        for table in ('search_client', 'search_staff'):
+            db.session.execute(text('DROP TABLE IF EXISTS {}'.format(table)))
+        db.drop_all()
+        cache.clear()
+
+
+@pytest.fixture
+def user(app):
+    db.session.add(Tariff(name='Free', default=True))
+    company = Company(name='Company')
+    db.session.add(company)
+    db.session.commit()
+    user = User(cid=company.id, username='user', email='user@example.com')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def client(app, user):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+        session['country'] = SESSION_COUNTRY
+    return client
+
+
+@pytest.fixture
+def request_user(app, user):
+    # user logged in within a request context, for code using current_user
+    with app.test_request_context():
+        login_user(user)
+        session['country'] = SESSION_COUNTRY
+        yield user
+
+
+@pytest.fixture
+def workplace(app, user):
+    # location and staff working 9:00-18:00 every day, staff hours apply
+    config = CompanyConfig(cid=user.cid, simple_mode=False)
+    db.session.add(config)
+    db.session.commit()
+    with app.test_request_context():
+        login_user(user)
+        location_schedule = Schedule(cid=user.cid, name='Location')
+        staff_schedule = Schedule(cid=user.cid, name='Staff')
+    location = Location(cid=user.cid, name='Location',
+                        schedules=[location_schedule])
+    staff = Staff(cid=user.cid, name='Staff', phone='+972520000001',
+                  schedules=[staff_schedule])
+    db.session.add_all([location, staff])
+    db.session.commit()
+    return location, staff, staff_schedule, config
@@ -0,0 +1,113 @@
+from datetime import datetime
+
+from app import db
+from app.models import Appointment, Client, Location, Service, Staff
+
+
+def auth(user):
+    return {'Authorization': 'Bearer ' + user.get_token()}
+
+
+def test_unknown_service_is_json_404(client, user):
+    response = client.post('/api/get_next_free_slots/', headers=auth(user),
+                           json={'services_id': '12345'})
+    assert response.status_code == 404
+    assert response.get_json()['message'] == 'Service not found'
+
+
+def add_staff(user):
+    staff = Staff(cid=user.cid, name='Staff', phone='+972520000001')
+    db.session.add(staff)
+    db.session.commit()
+    return staff
+
+
+def get_bulk_intervals(client, user, **data):
+    return client.post('/api/get_free_time_intervals_bulk/', headers=auth(user),
+                       json={'dates': ['2030-01-07'], **data})
+
+
+def test_unknown_location_is_json_404(client, user):
+    staff = add_staff(user)
+    response = get_bulk_intervals(client, user, location_id=12345,
+                                  staff_ids=[staff.id], duration=30)
+    assert response.status_code == 404
+    assert response.get_json()['message'] == 'Location not found'
+
+
+def test_bulk_intervals_reject_empty_duration(client, user):
+    staff = add_staff(user)
+    location = Location(cid=user.cid, name='Location')
+    service = Service(cid=user.cid, name='Service', duration=0, price=10)
+    db.session.add_all([location, service])
+    db.session.commit()
+    for data in ({'duration': 0}, {'duration': -30},
+                 {'services_id': str(service.id)}):
+        response = get_bulk_intervals(client, user, location_id=location.id,
+                                      staff_ids=[staff.id], **data)
+        assert response.status_code == 400
+    response = get_bulk_intervals(client, user, location_id=location.id,
+                                  staff_ids=[staff.id, 12345], duration=30)
+    assert response.status_code == 404
+    assert response.get_json()['message'] == 'Staff not found'
+    response = get_bulk_intervals(client, user, location_id=location.id,
+                                  staff_ids=[staff.id], duration=30)
+    assert response.status_code == 200
+    assert response.get_json()['staff'] == [staff.id]
+
+
+def test_bulk_create_rejects_busy_client(client, user):
+    location = Location(cid=user.cid, name='Location')
+    staff = Staff(cid=user.cid, name='Staff', phone='+972520000001')
+    other_staff = Staff(cid=user.cid, name='Other', phone='+972520000002')
+    visitor = Client(cid=user.cid, name='Client', phone='+972520000003')
+    service = Service(cid=user.cid, name='Service', duration=60, price=10)
+    db.session.add_all([location, staff, other_staff, visitor, service])
+    db.session.flush()
+    appointment = Appointment(cid=user.cid, location_id=location.id,
+                              staff_id=staff.id, client_id=visitor.id,
+                              date_time=datetime(2030, 1, 7, 10))
+    db.session.add(appointment)
+    appointment.add_service(service)
+    db.session.commit()
+
+    def item(hour, minute=0):
+        return {'location_id': location.id, 'staff_id': other_staff.id,
+                'client_id': visitor.id, 'services_id': str(service.id),
+                'date_time': '2030-01-07 {:02d}:{:02d}'.format(hour, minute)}
+
+    response = client.post('/api/create_appointments/', headers=auth(user),
+                           json={'appointments': [item(10, 30), item(11),
+                                                  item(11, 30)],
+                                 'check_free_time': False})
+    results = response.get_json()['results']
+    assert results[0]['error'] == 'Client is busy at this time'
+    assert 'id' in results[1]
+    assert results[2]['error'] == 'Client is busy at this time'
+
+
+def test_token_request_writes_no_session(app, user):
+    db.session.add(Client(cid=user.cid, name='Client', phone='+972520000003'))
+    db.session.commit()
+    client = app.test_client()
+    for _ in range(2):
+        response = client.get('/api/get_clients/', headers=auth(user))
+        assert response.status_code == 200
+        assert [c['name'] for c in response.get_json()['items'].values()] == [
+            'Client']
+        assert 'Set-Cookie' not in response.headers
+
+
+def test_list_hides_private_fields(client, user):
+    staff = add_staff(user)
+    response = client.get('/api/get_staff/', headers=auth(user))
+    assert response.status_code == 200
+    row = response.get_json()['items'][str(staff.id)]
+    assert row['name'] == 'Staff' and row['phone'] == '+972520000001'
+    assert not set(row) & {'cid', 'name_fold', 'phone_norm', 'phone_rev'}
+    response = client.get('/api/get_staff/?fields=name,phone_norm',
+                          headers=auth(user))
+    assert response.status_code == 400
+    response = client.get('/api/get_staff/?fields=name', headers=auth(user))
+    assert response.get_json()['items'][str(staff.id)] == {'id': staff.id,
+                                                           'name': 'Staff'}
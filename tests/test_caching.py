@@ -0,0 +1,91 @@
+from datetime import date, datetime, time
+
+from app import db
+from app.models import Appointment, Client, Holiday, Service
+from app.versions import get_versions
+
+DAY = date(2030, 1, 7)
+
+
+def auth(user):
+    return {'Authorization': 'Bearer ' + user.get_token()}
+
+
+def get_hours(client, user, location, staff):
+    response = client.post('/api/get_free_time_intervals/', headers=auth(user),
+                           json={'location_id': location.id,
+                                 'staff_id': staff.id, 'duration': 60,
+                                 'date': DAY.isoformat()})
+    assert response.status_code == 200
+    return [(start[17:22], end[17:22]) for start, end in response.get_json()]
+
+
+def test_appointment_commit_invalidates(client, user, workplace):
+    location, staff = workplace[:2]
+    assert get_hours(client, user, location, staff) == [('09:00', '17:00')]
+    visitor = Client(cid=user.cid, name='Client', phone='+972520000002')
+    service = Service(cid=user.cid, name='Service', duration=60, price=10)
+    db.session.add_all([visitor, service])
+    db.session.flush()
+    appointment = Appointment(cid=user.cid, location_id=location.id,
+                              staff_id=staff.id, client_id=visitor.id,
+                              date_time=datetime.combine(DAY, time(10)))
+    db.session.add(appointment)
+    appointment.add_service(service)
+    db.session.commit()
+    assert get_hours(client, user, location, staff) == [('09:00', '09:00'),
+                                                        ('11:00', '17:00')]
+
+
+def test_holiday_and_schedule_changes_invalidate(client, user, workplace):
+    location, staff, staff_schedule = workplace[:3]
+    assert get_hours(client, user, location, staff) == [('09:00', '17:00')]
+    monday = [d for d in staff_schedule.days if d.day_number == DAY.weekday()]
+    monday[0].hour_to = time(13)
+    db.session.commit()
+    assert get_hours(client, user, location, staff) == [('09:00', '12:00')]
+    holiday = Holiday(cid=user.cid, staff_id=staff.id, date=DAY,
+                      working_day=True, hour_from=time(14),
+                      hour_to=time(16))
+    db.session.add(holiday)
+    db.session.commit()
+    assert get_hours(client, user, location, staff) == [('14:00', '15:00')]
+    db.session.delete(holiday)
+    db.session.commit()
+    assert get_hours(client, user, location, staff) == [('09:00', '12:00')]
+
+
+def test_simple_mode_toggle_invalidates(client, user, workplace):
+    location, staff, staff_schedule, config = workplace
+    for day in staff_schedule.days:
+        day.hour_to = time(12)
+    db.session.commit()
+    assert get_hours(client, user, location, staff) == [('09:00', '11:00')]
+    config.simple_mode = True
+    db.session.commit()
+    assert get_hours(client, user, location, staff) == [('09:00', '17:00')]
+
+
+def test_appointment_without_staff(user, workplace):
+    location = workplace[0]
+    visitor = Client(cid=user.cid, name='Client', phone='+972520000002')
+    db.session.add(visitor)
+    db.session.flush()
+    db.session.add(Appointment(cid=user.cid, location_id=location.id,
+                               client_id=visitor.id,
+                               date_time=datetime.combine(DAY, time(10))))
+    db.session.commit()
+    assert 'availability_changes' not in db.session.info
+
+
+def test_rollback_keeps_versions(client, user, workplace):
+    location, staff = workplace[:2]
+    keys = [('availability', user.cid, 'day', staff.id, DAY)]
+    versions = get_versions(keys)
+    db.session.add(Holiday(cid=user.cid, staff_id=staff.id, date=DAY))
+    db.session.flush()
+    assert db.session.info['availability_changes'] == set(keys)
+    db.session.rollback()
+    assert 'availability_changes' not in db.session.info
+    assert get_versions(keys) == versions
+    assert get_hours(client, user, location, staff) == [('09:00', '17:00')]
@@ -0,0 +1,19 @@
+from app import db
+from app.cli import check_indexes, update_names
+from app.models import Staff
+
+
+def test_models_have_expected_indexes(app):
+    result = app.test_cli_runner().invoke(check_indexes)
+    assert result.output.strip().endswith('Missing indexes: 0'), result.output
+
+
+def test_update_names_fills_folded_names(app, user):
+    staff = Staff(cid=user.cid, name='ÉLODIE', phone='+972520000001')
+    db.session.add(staff)
+    db.session.commit()
+    db.session.query(Staff).update({'name_fold': None})
+    db.session.commit()
+    result = app.test_cli_runner().invoke(update_names)
+    assert 'Updated 1 staff' in result.output
+    assert db.session.get(Staff, staff.id).name_fold == 'élodie'
@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+from app.intervals import IntervalSet, get_free_intervals
+
+DAY = datetime(2023, 10, 16)
+
+
+def at(hour, minute=0, second=0):
+    return DAY.replace(hour=hour, minute=minute, second=second)
+
+
+def test_free_time_is_trimmed_to_staff_hours():
+    free = IntervalSet(DAY).add(at(8), at(22))
+    free &= IntervalSet(DAY).add(at(9), at(20))
+    assert free.fits(timedelta(minutes=45)).to_start_intervals() == [
+        (at(9), at(19, 15))]
+
+
+def test_overlapping_appointments_stay_busy():
+    timetable = [(at(10), at(12)), (at(10, 30), at(11)), (at(11, 30), at(13))]
+    free = get_free_intervals(at(9), at(18), timetable)
+    assert free == [(at(9), at(10)), (at(13), at(18))]
+    busy = IntervalSet.from_intervals(timetable, DAY, outer=True)
+    assert free == (IntervalSet(DAY).add(at(9), at(18)) - busy).to_intervals()
+    assert get_free_intervals(at(9), at(18), timetable,
+                              timedelta(hours=1)) == [(at(9), at(9)),
+                                                      (at(13), at(17))]
+
+
+def test_seconds_round_busy_time_outwards():
+    free = get_free_intervals(at(9, 0, 30), at(18), [(at(9, 15), at(9, 30, 20)),
+                                                   (at(12), at(12))])
+    assert free == [(at(9, 1), at(9, 15)), (at(9, 31), at(18))]
+    assert get_free_intervals(at(9), at(10), [],
+                              timedelta(minutes=59, seconds=1)) == [
+        (at(9), at(9))]
+    free_set = IntervalSet(DAY, intervals=free)
+    assert not free_set.contains(at(9, 30, 59))
+    assert free_set.contains(at(9, 31))
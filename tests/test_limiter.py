@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from app.limiter import Limiter, MemoryStore
+
+
+def test_bucket_refills(monkeypatch):
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr('app.limiter.time',
+                        SimpleNamespace(monotonic=lambda: clock.now))
+    store = MemoryStore()
+    assert store.take('key', 1, 2) == (True, 1, 1)
+    assert store.take('key', 1, 2) == (True, 0, 2)
+    assert store.take('key', 1, 2)[0] is False
+    clock.now += 1.5
+    assert store.take('key', 1, 2)[:2] == (True, 0)
+    clock.now += 10
+    assert store.take('key', 1, 2)[:2] == (True, 1)
+
+
+def test_empty_bucket_is_429(app, monkeypatch):
+    monkeypatch.setattr('app.limiter.DEFAULT_BURST', 2)
+    client = app.test_client()
+    remaining = []
+    for _ in range(2):
+        response = client.get('/api/get_staff/')
+        assert response.status_code == 401
+        assert response.headers['X-RateLimit-Limit'] == '60'
+        assert int(response.headers['X-RateLimit-Reset']) >= 1
+        remaining.append(response.headers['X-RateLimit-Remaining'])
+    assert remaining == ['1', '0']
+    response = client.get('/api/get_staff/',
+                          headers={'Authorization': 'Bearer new'})
+    assert response.status_code == 429
+    assert response.get_json()['message'] == 'Too many requests'
+    assert response.headers['Retry-After'] == '1'
+    assert client.get('/api/get_staff/', environ_base={
+        'REMOTE_ADDR': '10.0.0.2'}).status_code == 401
+
+
+def test_forwarded_address_keys_bucket(app, monkeypatch):
+    monkeypatch.setattr('app.limiter.DEFAULT_BURST', 1)
+    monkeypatch.setattr(app, 'wsgi_app', ProxyFix(app.wsgi_app, x_for=1))
+    client = app.test_client()
+
+    def get(address):
+        return client.get('/api/get_staff/', environ_base={
+            'REMOTE_ADDR': '10.0.0.1'}, headers={'X-Forwarded-For': address})
+
+    assert get('192.0.2.1').status_code == 401
+    assert get('192.0.2.2').status_code == 401
+    assert get('192.0.2.1').status_code == 429
+
+
+def test_known_token_uses_tenant_policy():
+    limiter = Limiter()
+    limiter.set_policy('token', 1, None)
+    assert limiter.check('token', '10.0.0.1')[0]
+    assert limiter.store.buckets.keys() == {('cid', 1)}
@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+
+from flask_login import login_user
+from sqlalchemy import event, inspect
+
+from app import db
+from app.models import (Appointment, Client, Company, Location, Service, Staff,
+                        Tag)
+
+
+def test_find_by_phone_skips_inactive(app, user):
+    db.session.add(Client(cid=user.cid, name='Old', phone='+972521234567',
+                          no_active=True))
+    db.session.commit()
+    with app.test_request_context():
+        login_user(user)
+        assert Client.find_by_phone('972 52-123-4567') is None
+        db.session.add(Client(cid=user.cid, name='New', phone='+972521234567'))
+        db.session.commit()
+        assert Client.find_by_phone('972 52-123-4567').name == 'New'
+
+
+def test_catalog_relationships_are_lazy():
+    # benchmarks/loading.py measures these settings on a reduced schema
+    relationships = [inspect(Location).relationships['services'],
+                     inspect(Service).relationships['locations'],
+                     inspect(Service).relationships['appointment_services'],
+                     inspect(Client).relationships['tags'],
+                     inspect(Tag).relationships['clients']]
+    assert all(r.lazy in ('select', True) for r in relationships)
+
+
+def test_location_load_skips_history(app, user):
+    visitor = Client(cid=user.cid, name='Client', phone='+972520000001')
+    service = Service(cid=user.cid, name='Service', duration=30, price=10)
+    location = Location(cid=user.cid, name='Location', services=[service])
+    db.session.add_all([visitor, location])
+    db.session.flush()
+    for i in range(20):
+        appointment = Appointment(cid=user.cid, location_id=location.id,
+                                  client_id=visitor.id,
+                                  date_time=datetime(2030, 1, 7, 9) +
+                                  timedelta(hours=i))
+        db.session.add(appointment)
+        appointment.add_service(service)
+    db.session.commit()
+    location_id, service_id = location.id, service.id
+    db.session.expunge_all()
+    statements = []
+
+    def collect(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', collect)
+    try:
+        location = db.session.get(Location, location_id)
+        assert [s.name for s in location.services] == ['Service']
+        assert db.session.get(Service, service_id).duration == 30
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', collect)
+    assert len(statements) == 2
+    assert not any('appointment' in s for s in statements)
+
+
+def test_request_cache_skips_repeated_lookups(request_user):
+    other = Company(name='Other')
+    db.session.add(other)
+    db.session.flush()
+    staff = Staff(cid=request_user.cid, name='Staff', phone='+972520000001')
+    foreign = Staff(cid=other.id, name='Foreign', phone='+972520000002')
+    db.session.add_all([staff, foreign])
+    db.session.commit()
+    # refresh the objects expired by the commit before counting
+    assert staff.id and foreign.id and request_user.cid
+    statements = []
+
+    def collect(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', collect)
+    try:
+        assert Staff.get_object(staff.id) is staff
+        assert Staff.get_object(staff.id) is staff
+        assert Staff.get_objects([staff.id, staff.id]) == [staff, staff]
+        assert Staff.find_object({'id': staff.id}) is staff
+        assert len(statements) == 1
+        assert Staff.get_object(foreign.id, overall=True) is foreign
+        assert Staff.get_object(foreign.id, overall=True) is foreign
+        assert len(statements) == 2
+        assert Staff.get_object(foreign.id, mode_404=False) is None
+        assert Staff.get_objects([staff.id, foreign.id],
+                                 mode_404=False) == [staff]
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', collect)
+    staff.no_active = True
+    db.session.commit()
+    assert Staff.get_object(staff.id, mode_404=False) is None
+
+
+def test_choices_follow_name_changes(app, client, user):
+    staff = Staff(cid=user.cid, name='First', phone='+972520000001')
+    db.session.add(staff)
+    db.session.commit()
+    html = client.get('/holidays/create/').get_data(as_text=True)
+    assert 'First' in html
+    db.session.add(Staff(cid=user.cid, name='Second', phone='+972520000002'))
+    staff.name = 'Renamed'
+    db.session.commit()
+    html = client.get('/holidays/create/').get_data(as_text=True)
+    assert 'Second' in html and 'Renamed' in html and 'First' not in html
+    service = Service(cid=user.cid, name='Cut', duration=30, price=10)
+    db.session.add(service)
+    db.session.commit()
+    with app.test_request_context():
+        login_user(user)
+        assert Service.get_choices() == [(service.id, 'Cut')]
+        service.name = 'Color'
+        db.session.commit()
+        assert Service.get_choices() == [(service.id, 'Color')]
+        service.no_active = True
+        db.session.commit()
+        assert Service.get_choices() == []
@@ -0,0 +1,100 @@
+from datetime import date, datetime
+
+import pytest
+from flask import render_template_string
+
+from app import db
+from app.models import Appointment, Client, Holiday, Location, Staff
+
+
+@pytest.fixture(autouse=True)
+def per_page(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'ROWS_PER_PAGE', 2)
+
+
+def walk(class_object):
+    # pages forward to the end, then back to the start
+    pages = [class_object.get_keyset_pagination()]
+    while pages[-1].has_next:
+        pages.append(class_object.get_keyset_pagination(pages[-1].next_cursor))
+    back = [pages[-1]]
+    while back[-1].has_prev:
+        back.append(class_object.get_keyset_pagination(back[-1].prev_cursor))
+    return ([[i.id for i in page.items] for page in pages],
+            [[i.id for i in page.items] for page in reversed(back)])
+
+
+def test_keyset_pages_rows_of_one_date(request_user):
+    staff = [Staff(cid=request_user.cid, name='Staff {}'.format(i),
+                   phone='+97252000000{}'.format(i)) for i in range(5)]
+    db.session.add_all(staff)
+    db.session.flush()
+    days = [date(2030, 1, 7)] * 3 + [date(2030, 1, 6)] * 2
+    holidays = [Holiday(cid=request_user.cid, staff_id=s.id, date=d)
+                for s, d in zip(staff, days)]
+    db.session.add_all(holidays)
+    db.session.commit()
+    ids = [h.id for h in holidays]
+    forward, backward = walk(Holiday)
+    assert forward == [[ids[2], ids[1]], [ids[0], ids[4]], [ids[3]]]
+    assert backward == forward
+    cursor = Holiday.get_keyset_pagination().next_cursor
+    assert Holiday.decode_cursor(cursor) == (days[1], ids[1], 'next')
+
+
+def test_keyset_datetime_cursor(request_user):
+    location = Location(cid=request_user.cid, name='Location')
+    visitor = Client(cid=request_user.cid, name='Client',
+                     phone='+972520000001')
+    db.session.add_all([location, visitor])
+    db.session.flush()
+    times = [datetime(2030, 1, 7, 10, 30, 15)] * 2 + [datetime(2030, 1, 7, 9)]
+    appointments = [Appointment(cid=request_user.cid, location_id=location.id,
+                                client_id=visitor.id, date_time=t)
+                    for t in times]
+    db.session.add_all(appointments)
+    db.session.commit()
+    ids = [a.id for a in appointments]
+    first = Appointment.get_keyset_pagination()
+    assert Appointment.decode_cursor(first.next_cursor) == (times[0], ids[0],
+                                                            'next')
+    assert not first.has_prev
+    last = Appointment.get_keyset_pagination(first.next_cursor)
+    assert [a.id for a in last.items] == [ids[2]]
+    assert not last.has_next and last.next_cursor is None
+    assert walk(Appointment)[0] == [[ids[1], ids[0]], [ids[2]]]
+
+
+def test_broken_cursor_is_rejected():
+    assert Holiday.decode_cursor('not a cursor') is None
+    assert Holiday.decode_cursor(Holiday.encode_cursor(
+        Holiday(id=1, date=date(2030, 1, 7)), 'sideways')) is None
+
+
+def render(pagination):
+    return render_template_string(
+        '{% import "_pagination.html" as forms %}'
+        '{{ forms.render_pagination(pagination, "staff_table") }}',
+        pagination=pagination)
+
+
+def test_count_free_boundary_page(request_user):
+    db.session.add_all([Staff(cid=request_user.cid, name='Staff {}'.format(i),
+                              phone='+97252000000{}'.format(i))
+                        for i in range(4)])
+    db.session.commit()
+    search = [Staff.name.like('Staff%')]
+    first = Staff.get_pagination(1, data_search=search)
+    last = Staff.get_pagination(2, data_search=search)
+    assert first.total is None and last.total is None
+    assert first.has_next and not last.has_next
+    assert len(last.items) == 2
+    assert Staff.get_pagination(3, data_search=search).items == []
+    html = render(last)
+    assert 'page=1' in html and 'page=3' not in html
+    assert '...' not in html
+    assert 'page=2' in render(first)
+    estimated = Staff.get_pagination(2)
+    assert estimated.total == 4 and not estimated.has_next
+    assert list(estimated.iter_pages()) == [1, 2]
+    assert 'page=3' not in render(estimated)
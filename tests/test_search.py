@@ -0,0 +1,49 @@
+from app import db
+from app.cli import rebuild_search_index
+from app.models import Client
+
+
+def add_clients(user, *names):
+    for name in names:
+        number = Client.query.count()
+        db.session.add(Client(cid=user.cid, name=name,
+                              phone='+97252000{:04d}'.format(number)))
+        db.session.commit()
+
+
+def test_name_search_without_index(client, user):
+    add_clients(user, 'Bobby Tables', 'Alice Smith')
+    response = client.get('/clients/?name=bob')
+    assert response.status_code == 200
+    assert 'Bobby Tables' in response.get_data(as_text=True)
+    assert 'Alice Smith' not in response.get_data(as_text=True)
+
+
+def test_name_search_with_index(app, client, user):
+    add_clients(user, 'Bobby Tables', 'Иван Петров')
+    app.test_cli_runner().invoke(rebuild_search_index)
+    add_clients(user, 'Alice Bobrova')
+    response = client.get('/clients/?name=bob')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'Bobby Tables' in body and 'Alice Bobrova' in body
+    response = client.get('/clients/?name=Ива')
+    assert 'Иван Петров' in response.get_data(as_text=True)
+
+
+def test_phone_search(client, user):
+    db.session.add_all([Client(cid=user.cid, name='Middle', phone='+972521234567'),
+                        Client(cid=user.cid, name='Other', phone='+972549876543')])
+    db.session.commit()
+    for term in ('52123', '4567', '%2B97252'):
+        body = client.get('/clients/?phone=' + term).get_data(as_text=True)
+        assert 'Middle' in body and 'Other' not in body
+
+
+def test_typeahead_non_ascii(client, user):
+    add_clients(user, 'Иван Петров', 'иван Сидоров', 'Bob')
+    for prefix in ('ив', 'Ив', 'ИВАН'):
+        items = client.get('/typeahead/client/?q=' + prefix).get_json()
+        assert sorted(i['name'] for i in items) == ['Иван Петров', 'иван Сидоров']
+    items = client.get('/typeahead/client/?q=иван п').get_json()
+    assert [i['name'] for i in items] == ['Иван Петров']
@@ -0,0 +1,53 @@
+from datetime import datetime
+
+from flask_login import login_user
+
+from app import db
+from app.functions import create_series
+from app.models import Appointment, Client, Recurrence, Service
+
+START = datetime(2030, 1, 7, 10)
+
+
+def test_get_dates():
+    assert Recurrence.get_dates(Recurrence.weekly, START, 2, 2) == [
+        datetime(2030, 1, 21, 10), datetime(2030, 2, 4, 10)]
+    assert Recurrence.get_dates(Recurrence.days, START, 1, 3) == [
+        datetime(2030, 1, 10, 10)]
+    assert Recurrence.get_dates(Recurrence.service, START, 1,
+                                period=30) == [datetime(2030, 2, 6, 10)]
+    assert Recurrence.get_dates(Recurrence.weekly, START, 0) == []
+    assert Recurrence.get_dates(Recurrence.weekly, START, 3, 0) == []
+    assert Recurrence.get_dates(Recurrence.service, START, 3) == []
+    assert Recurrence.get_dates(0, START, 3) == []
+
+
+def test_series_skips_busy_occurrence(app, user, workplace):
+    location, staff = workplace[:2]
+    visitor = Client(cid=user.cid, name='Client', phone='+972520000002')
+    other = Client(cid=user.cid, name='Other', phone='+972520000003')
+    service = Service(cid=user.cid, name='Service', duration=60, price=10)
+    db.session.add_all([visitor, other, service])
+    db.session.flush()
+    appointments = []
+    for client_id, date_time in ((visitor.id, START),
+                                 (other.id, datetime(2030, 1, 21, 10, 30))):
+        appointment = Appointment(cid=user.cid, location_id=location.id,
+                                  staff_id=staff.id, client_id=client_id,
+                                  date_time=date_time)
+        db.session.add(appointment)
+        appointment.add_service(service)
+        appointments.append(appointment)
+    db.session.commit()
+    first, busy = appointments
+    with app.test_request_context():
+        login_user(user)
+        created = create_series(first, Recurrence.weekly, 3)
+        db.session.commit()
+    assert [a.date_time for a in created] == [datetime(2030, 1, 14, 10),
+                                              datetime(2030, 1, 28, 10)]
+    assert first.series_id == first.id
+    assert all(a.series_id == first.id for a in created)
+    assert busy.series_id is None
+    series = Appointment.query.filter_by(series_id=first.id).count()
+    assert series == 3
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import Client, Service, Staff
+
+PAST = datetime(2020, 1, 1)
+
+
+def auth(user):
+    return {'Authorization': 'Bearer ' + user.get_token()}
+
+
+def get_changes(client, user, **args):
+    response = client.get('/api/changes/', headers=auth(user),
+                          query_string=args)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_cursor_pages_across_tables(client, user):
+    items = [Client(cid=user.cid, name='Client {}'.format(i),
+                    phone='+97252000010{}'.format(i), timestamp_update=PAST)
+             for i in range(3)]
+    items += [Staff(cid=user.cid, name='Staff {}'.format(i),
+                    phone='+97252000020{}'.format(i), timestamp_update=PAST)
+              for i in range(2)]
+    items.append(Service(cid=user.cid, name='Service', duration=30, price=10,
+                         timestamp_update=PAST - timedelta(minutes=1)))
+    db.session.add_all(items)
+    db.session.commit()
+    seen = []
+    cursor = None
+    while True:
+        data = get_changes(client, user, limit=2, **({'cursor': cursor}
+                                                     if cursor else {}))
+        seen.extend((c['table'], c['id']) for c in data['changes'])
+        cursor = data['cursor']
+        if not data['more']:
+            break
+    assert seen[0] == ('service', items[-1].id)
+    assert len(seen) == len(set(seen)) == len(items)
+    assert not get_changes(client, user, cursor=cursor)['changes']
+    row = get_changes(client, user, tables='staff')['changes'][0]['data']
+    assert not set(row) & {'cid', 'name_fold', 'phone_norm', 'phone_rev'}
+
+
+def test_deletions_are_reported(client, user, monkeypatch):
+    monkeypatch.setattr('app.sync.SYNC_DELAY', timedelta())
+    removed = Client(cid=user.cid, name='Removed', phone='+972520000101')
+    hidden = Client(cid=user.cid, name='Hidden', phone='+972520000102')
+    db.session.add_all([removed, hidden])
+    db.session.commit()
+    cursor = get_changes(client, user)['cursor']
+    removed_id = removed.id
+    db.session.delete(removed)
+    hidden.no_active = True
+    db.session.commit()
+    changes = get_changes(client, user, cursor=cursor)['changes']
+    assert sorted((c['id'], c['deleted'], c['data']) for c in changes) == \
+        sorted([(removed_id, True, None), (hidden.id, True, None)])
+    assert not get_changes(client, user, cursor=cursor,
+                           tables='staff')['changes']
+
+
+def test_recent_changes_are_held_back(client, user):
+    db.session.add(Client(cid=user.cid, name='New', phone='+972520000103'))
+    db.session.commit()
+    data = get_changes(client, user)
+    assert data['changes'] == [] and data['more'] is False